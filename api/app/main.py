@@ -2,27 +2,42 @@ import asyncio
 import datetime
 import json
 import logging
-from fastapi import FastAPI, Form, UploadFile, File, HTTPException
+from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-import aio_pika
 
+import os
 import shutil
 import tempfile
-import os
-from typing import List
+from typing import Iterable, List, Optional, Tuple
 import zipfile
+from collections import deque
+from contextlib import aclosing
 from .models.yolo_detector import YOLODetector
+from .models.renderer import OverlayRenderer
+from .models.overlay_store import OverlayStore
+from .models.detection_cache import DetectionCache
+from .models.cascade import CascadeRules
+from .models.registry import ModelRegistry
+from .models.tiling import TilingConfig
+from .models.jobs import Job, JobManager
+from .models.publisher import ResultPublisher
+from .models.admission import AdmissionController, Overloaded, LANE_BULK, LANE_INTERACTIVE
 from .config import Settings
 
+from app2.user_config import UserConfigStore, consume_settings_changed
+from app2.wire_format import encode_operation
 from app2.DTO.DataBaseClasses import RecognitionOperationModel, ImageRecognitionDataModel, RecognitionResult, SummaryModel
 
 # Определяем базовую директорию из переменной окружения DATA_DIR или используем fallback
 DATA_DIR = Path(os.environ.get("DATA_DIR", Path(__file__).parent.parent))
 STATIC_DIR = DATA_DIR / "static"
 RESULTS_DIR = STATIC_DIR / "results"
+SOURCES_DIR = STATIC_DIR / "sources"
+DETECTION_CACHE_DIR = DATA_DIR / "cache/detections"
+MODELS_DIR = DATA_DIR / "models"
 CONFIG_FILE_PATH = DATA_DIR / "config/UserConfig.json"
 
 # Создаем необходимые директории
@@ -61,21 +76,135 @@ app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 
 # Инициализация детектора YOLO
 settings = Settings()
-detector = YOLODetector(
-    model_path1=settings.yolo_model1_path,
-    model_path2=settings.yolo_model2_path,
-    confidence_threshold=settings.confidence_threshold
+renderer = OverlayRenderer(workers=settings.render_workers, queue_size=settings.render_queue_size)
+overlay_store = OverlayStore(
+    RESULTS_DIR, SOURCES_DIR, renderer,
+    cache_bytes=settings.render_cache_mb * 1024 * 1024,
+    max_source_bytes=settings.render_sources_max_mb * 1024 * 1024,
+    retention_seconds=settings.render_retention_days * 24 * 3600,
+    cleanup_interval=settings.render_cleanup_interval
+)
+detection_cache = DetectionCache(
+    max_entries=settings.detection_cache_entries,
+    disk_dir=str(DETECTION_CACHE_DIR) if settings.detection_cache_disk else None,
+    disk_max_entries=settings.detection_cache_disk_entries
+) if settings.detection_cache_entries > 0 else None
+
+def build_detector(model_paths: List[str]) -> YOLODetector:
+    """Детектор для версии весов: model_paths - две основные модели и дополнительные"""
+    return YOLODetector(
+        model_path1=model_paths[0],
+        model_path2=model_paths[1],
+        confidence_threshold=settings.confidence_threshold,
+        max_batch_size=settings.batch_max_size,
+        batch_window_ms=settings.batch_window_ms,
+        renderer=renderer,
+        overlay_store=overlay_store,
+        render_mode=settings.render_mode,
+        detection_cache=detection_cache,
+        merge_engine=settings.merge_engine,
+        extra_model_paths=model_paths[2:],
+        fusion_mode=settings.fusion_mode,
+        wbf_iou_threshold=settings.wbf_iou_threshold,
+        wbf_skip_box_threshold=settings.wbf_skip_box_threshold,
+        wbf_conf_type=settings.wbf_conf_type,
+        ensemble_mode=settings.ensemble_mode,
+        cascade_rules=CascadeRules(
+            low_confidence=settings.cascade_low_confidence,
+            high_confidence=settings.cascade_high_confidence,
+            conflict_iou=settings.cascade_conflict_iou,
+            expected_count=settings.cascade_expected_count
+        ),
+        backend=settings.inference_backend,
+        backend_sessions=settings.inference_sessions,
+        backend_threads=settings.inference_threads,
+        tiling=TilingConfig(
+            trigger_size=settings.tiling_trigger_size,
+            tile_size=settings.tiling_tile_size,
+            overlap=settings.tiling_overlap,
+            match_threshold=settings.tiling_match_threshold,
+            include_full_image=settings.tiling_include_full_image
+        ),
+        scaled_decode=settings.scaled_decode
+    )
+
+
+# Реестр версий весов: активный детектор подменяется без перезапуска
+model_registry = ModelRegistry(build_detector, str(MODELS_DIR / "registry.json"), str(MODELS_DIR),
+                               warmup_runs=settings.model_warmup_runs)
+model_registry.bootstrap([settings.yolo_model1_path, settings.yolo_model2_path, *settings.yolo_extra_model_paths])
+
+# Настройки пользователя держим в памяти: файл перечитывается фоновой проверкой
+# и по сообщению settings_changed от app2, а не на каждое изображение
+user_config = UserConfigStore(str(CONFIG_FILE_PATH), poll_interval=settings.user_config_poll_interval)
+user_config.refresh()
+
+# Фоновые задачи распознавания: запрос возвращает id задачи, ход работы - через SSE/WebSocket
+job_manager = JobManager(workers=settings.job_workers, max_queued=settings.job_max_queued,
+                         ttl_seconds=settings.job_ttl_seconds, max_finished=settings.job_max_finished)
+
+# Допуск к инференсу: ограниченное число одновременных распознаваний,
+# одиночные проверки (interactive) не ждут за архивами (bulk)
+admission = AdmissionController(
+    slots=settings.admission_slots,
+    bulk_slots=settings.admission_bulk_slots,
+    queue_limits={LANE_INTERACTIVE: settings.admission_interactive_queue, LANE_BULK: settings.admission_bulk_queue},
+    timeouts={LANE_INTERACTIVE: settings.admission_interactive_timeout, LANE_BULK: settings.admission_bulk_timeout}
+)
+
+# Публикация результатов в RabbitMQ: одно подключение на приложение, пул каналов,
+# подтверждения брокера и локальный буфер на время недоступности брокера
+result_publisher = ResultPublisher(
+    settings.message_queue_url,
+    channels=settings.publish_channels,
+    batch_window_ms=settings.publish_batch_window_ms,
+    max_batch=settings.publish_max_batch,
+    outbox_size=settings.publish_outbox_size,
+    encoder=lambda operation: encode_operation(operation, settings.message_format)
 )
 
 def read_recognition() -> float:
-    """Чтение конфигурационного файла"""
+    """Порог распознавания из снимка конфигурации (без обращения к файлу)"""
     try:
-        with open(CONFIG_FILE_PATH, 'r', encoding='utf-8') as file:
-            return float(json.load(file)["SystemSettings"]["recognition"]["recognition"])/100
+        return float(user_config.get()["SystemSettings"]["recognition"]["recognition"])/100
     except Exception:
         return 0.5
 
 
+@app.on_event("startup")
+async def startup_event():
+    logger.info("App starting up - starting overlay renderer")
+    renderer.start()
+    overlay_store.start()
+    user_config.start()
+    job_manager.start()
+    result_publisher.start()
+    app.state.settings_listener = asyncio.create_task(
+        consume_settings_changed(settings.message_queue_url, user_config)
+    )
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.settings_listener.cancel()
+    user_config.stop()
+    await job_manager.shutdown()
+    # Результаты завершившихся запросов отправляются до остановки
+    await result_publisher.shutdown(timeout=settings.publish_drain_timeout)
+    overlay_store.stop()
+    renderer.shutdown()
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """Перегрузка: быстрый отказ с подсказкой, когда повторить"""
+    logger.warning(f"{request.method} {request.url.path} - Rejected, {str(exc)}")
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": f"Server is busy ({exc.reason}), retry later", "lane": exc.lane},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
 @app.get("/")
 async def read_root():
     """Корневой эндпоинт"""
@@ -95,42 +224,47 @@ async def detect_single_image(toolset: str = Form(...), file: UploadFile = File(
         logger.warning(f"POST /api/recognize/single - File must be an image: {file.filename}")
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        shutil.copyfileobj(file.file, temp_file)
-        temp_path = temp_file.name
+    # Изображение декодируется прямо из буфера загрузки, без временного файла
+    image_bytes = await file.read()
 
     try:
-        # Обработка изображения через YOLO
-        detector.confidence_threshold = read_recognition()
-        logger.info(f"Trust threshold set: {detector.confidence_threshold}")
-        
-        result = await detector.detect_image(temp_path)
+        # Обработка изображения через YOLO (весь запрос - на одной версии моделей)
+        async with admission.admit(LANE_INTERACTIVE), model_registry.use() as detector:
+            detector.confidence_threshold = read_recognition()
+            logger.info(f"Trust threshold set: {detector.confidence_threshold}")
+
+            result = await detector.detect_image(image_bytes, file_name=file.filename)
         result['file_name'] = file.filename
         result['toolset'] = toolset
         modeled_data = convert_raw_to_model([result]).model_dump()
 
         logger.info(f"POST /api/recognize/single - Successful processing. Objects found: {len(result.get('detections', []))}")
         
-        asyncio.create_task(publish_result(modeled_data)) # Публикация результата в очередь сообщений
+        result_publisher.publish(modeled_data) # Публикация результата в очередь сообщений
         return JSONResponse(content=modeled_data)
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"POST /api/recognize/single - Error while processing image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-    finally:
-        os.unlink(temp_path)
 
 @app.post("/api/recognize/multiple")
-async def detect_multiple_images(toolset: str = Form(...), files: List[UploadFile] = File(...)):
-    """Endpoint для обработки нескольких изображений"""
+async def detect_multiple_images(request: Request, toolset: str = Form(...), files: List[UploadFile] = File(...),
+                                 stream: bool = Query(False)):
+    """
+    Endpoint для обработки нескольких изображений.
+    stream=true (или Accept: application/x-ndjson) - ответ в формате NDJSON:
+    запись на каждое изображение по готовности и итоговая запись summary.
+    """
     logger.info(f"POST /api/recognize/multiple - Start of processing {len(files)} image. Toolset: {toolset}")
     
     if not files:
         logger.warning("POST /api/recognize/multiple - No files provided")
         raise HTTPException(status_code=400, detail="No files provided")
     
-    results = []
     valid_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp']
-    processed_files = 0
+    images = []
+    file_names = []
     
     for file in files:
         if not file.filename:
@@ -139,33 +273,106 @@ async def detect_multiple_images(toolset: str = Form(...), files: List[UploadFil
             logger.warning(f"POST /api/recognize/multiple - Invalid file missing: {file.filename}")
             continue
             
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            shutil.copyfileobj(file.file, temp_file)
-            temp_path = temp_file.name
-            
-        try:
+        images.append(await file.read())
+        file_names.append(file.filename)
+
+    if stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        # Отказ при перегрузке - до начала ответа, пока можно вернуть 429
+        admission.check(LANE_BULK)
+        return StreamingResponse(
+            stream_recognition(toolset, list(zip(file_names, images))),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    results = []
+    try:
+        async with admission.admit(LANE_BULK), model_registry.use() as detector:
             detector.confidence_threshold = read_recognition()
-            result = await detector.detect_image(temp_path)
-            result['file_name'] = file.filename
+            # Все изображения запроса обрабатываются батчами по settings.recognition_batch_size
+            batch_results = await detector.detect_images(images, batch_size=settings.recognition_batch_size,
+                                                         file_names=file_names)
+        for file_name, result in zip(file_names, batch_results):
+            if result is None:
+                logger.error(f"POST /api/recognize/multiple - Error processing file {file_name}")
+                continue
+            result['file_name'] = file_name
             result['toolset'] = toolset
             results.append(result)
-            processed_files += 1
-        except Exception as e:
-            logger.error(f"POST /api/recognize/multiple - Error processing file {file.filename}: {str(e)}")
-        finally:
-            os.unlink(temp_path)
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"POST /api/recognize/multiple - Error processing files: {str(e)}")
+    processed_files = len(results)
     
     if not results:
         logger.warning("POST /api/recognize/multiple - Failed to process any files")
         raise HTTPException(status_code=400, detail="No valid images processed")
     
     modeled_data = convert_raw_to_model(results).model_dump()
-    asyncio.create_task(publish_result(modeled_data)) # Публикация результата в очередь сообщений
+    result_publisher.publish(modeled_data) # Публикация результата в очередь сообщений
 
     logger.info(f"POST /api/recognize/multiple - Successfully processed {processed_files} из {len(files)} files")
     return JSONResponse(content=modeled_data)
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def image_record(result: dict) -> dict:
+    """ImageRecognitionDataModel одного изображения"""
+    return convert_raw_to_model([result]).images[0].model_dump()
+
+async def stream_recognition(toolset: str, sources: List[Tuple[str, bytes]]):
+    """
+    NDJSON-поток распознавания: {"type": "image", ...} на каждое изображение по мере готовности,
+    {"type": "error", ...} на непрочитанное, в конце {"type": "summary", ...} - операция без списка изображений.
+    Изображение (и его base64) освобождается сразу после отправки, для итоговой операции
+    хранятся только детекции, поэтому память запроса не растет с числом изображений.
+    """
+    results = []
+    total = len(sources)
+    pending = deque(sources)
+    sources.clear()
+
+    def take_sources():
+        # Загруженные байты отпускаются по мере передачи в декодирование
+        while pending:
+            yield pending.popleft()
+
+    try:
+        async with admission.admit(LANE_BULK), model_registry.use() as detector:
+            detector.confidence_threshold = read_recognition()
+            async with aclosing(detector.detect_stream(
+                take_sources(),
+                batch_size=settings.recognition_batch_size,
+                max_in_flight=settings.archive_max_in_flight
+            )) as stream:
+                async for name, result in stream:
+                    if result is None:
+                        logger.error(f"POST /api/recognize/multiple - Error processing file {name}")
+                        yield json.dumps({"type": "error", "fileName": name, "detail": "Image could not be processed"}) + "\n"
+                        continue
+                    result['file_name'] = name
+                    result['toolset'] = toolset
+                    yield json.dumps({"type": "image", **image_record(result)}) + "\n"
+                    result.pop('image_base64', None)
+                    results.append(result)
+    except Exception as e:
+        logger.error(f"POST /api/recognize/multiple - Error processing files: {str(e)}")
+        yield json.dumps({"type": "error", "detail": f"Internal server error: {str(e)}"}) + "\n"
+        return
+
+    if not results:
+        yield json.dumps({"type": "error", "detail": "No valid images processed"}) + "\n"
+        return
+
+    modeled_data = convert_raw_to_model(results).model_dump()
+    result_publisher.publish(modeled_data) # Публикация результата в очередь сообщений
+    summary = {key: value for key, value in modeled_data.items() if key != "images"}
+    yield json.dumps({"type": "summary", **summary}) + "\n"
+    logger.info(f"POST /api/recognize/multiple - Streamed {len(results)} of {total} files")
+
+
 @app.post("/api/recognize/archive")
 async def detect_from_archive(toolset: str = Form(...), file: UploadFile = File(...)):
     """Endpoint для обработки архива с изображениями"""
@@ -180,62 +387,276 @@ async def detect_from_archive(toolset: str = Form(...), file: UploadFile = File(
         raise HTTPException(status_code=400, detail="File must be a ZIP archive")
 
     results = []
-    temp_dir = tempfile.mkdtemp()
     processed_images = 0
     
     try:
-        # Сохраняем архив
-        zip_path = os.path.join(temp_dir, "upload.zip")
-        with open(zip_path, "wb") as temp_zip:
-            shutil.copyfileobj(file.file, temp_zip)
-            
-        # Распаковываем архив
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-            
-        # Обрабатываем все изображения
-        for root, _, files in os.walk(temp_dir):
-            for filename in files:
-                if any(filename.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png']):
-                    file_path = os.path.join(root, filename)
-
-                    detector.confidence_threshold = read_recognition()
-                    result = await detector.detect_image(file_path)
-                    result['file_name'] = file.filename
-                    result['toolset'] = toolset
-                    results.append(result)
-                    processed_images += 1
+        # Архив читается прямо из буфера загрузки: без копии на диск и extractall,
+        # члены архива декодируются по одному по мере продвижения инференса
+        async with admission.admit(LANE_BULK), model_registry.use() as detector:
+            with zipfile.ZipFile(file.file, 'r') as zip_ref:
+                detector.confidence_threshold = read_recognition()
+                async with aclosing(detector.detect_stream(
+                    iter_archive_images(zip_ref),
+                    batch_size=settings.recognition_batch_size,
+                    max_in_flight=settings.archive_max_in_flight
+                )) as stream:
+                    async for _, result in stream:
+                        if result is None:
+                            continue
+                        result['file_name'] = file.filename
+                        result['toolset'] = toolset
+                        results.append(result)
+                        processed_images += 1
                     
         if not results:
             logger.warning("POST /api/recognize/archive - No suitable images were found in the archive.")
             raise HTTPException(status_code=400, detail="No valid images found in archive")
             
         modeled_data = convert_raw_to_model(results).model_dump()
-        asyncio.create_task(publish_result(modeled_data)) # Публикация результата в очередь сообщений
+        result_publisher.publish(modeled_data) # Публикация результата в очередь сообщений
 
         logger.info(f"POST /api/recognize/archive - Successfully processed {processed_images} images from archive")
         return JSONResponse(content=modeled_data)
     
+    except Overloaded:
+        raise
     except Exception as e:
         logger.error(f"POST /api/recognize/archive - Error processing archive: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
-    finally:
-        shutil.rmtree(temp_dir)
 
-async def publish_result(result: dict):
-    """Публикация результата в очередь сообщений"""
+def archive_image_members(zip_ref: zipfile.ZipFile) -> List[zipfile.ZipInfo]:
+    return [
+        info for info in zip_ref.infolist()
+        if not info.is_dir() and any(info.filename.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png'])
+    ]
+
+def iter_archive_images(zip_ref: zipfile.ZipFile):
+    """Ленивый обход изображений архива; член архива открыт, пока его декодируют"""
+    for info in archive_image_members(zip_ref):
+        with zip_ref.open(info) as member:
+            yield info.filename, member
+
+
+async def run_recognition_job(job: Job, toolset: str, sources: Iterable[Tuple[str, object]],
+                              archive_name: Optional[str] = None) -> dict:
+    """
+    Распознавание в фоновой задаче: результат каждого изображения отправляется
+    подписчикам сразу, итоговая операция - после последнего изображения.
+    """
+    results = []
+    # У задач своя очередь, поэтому слот bulk ожидается без лимита и таймаута
+    async with admission.admit(LANE_BULK, bounded=False), model_registry.use() as detector:
+        detector.confidence_threshold = read_recognition()
+        async with aclosing(detector.detect_stream(
+            sources,
+            batch_size=settings.recognition_batch_size,
+            max_in_flight=settings.archive_max_in_flight
+        )) as stream:
+            async for name, result in stream:
+                if result is None:
+                    logger.error(f"Job {job.id} - Error processing file {name}")
+                    job.image_done(None, fileName=name)
+                    continue
+                result['file_name'] = archive_name or name
+                result['toolset'] = toolset
+                # Отрисовка уже есть на диске или в /api/render - base64 в задаче не храним
+                result.pop('image_base64', None)
+                results.append(result)
+                record = image_record(result)
+                record.pop('imageBase64', None)
+                job.image_done(record, fileName=name)
+
+    if not results:
+        raise ValueError("No valid images processed")
+
+    modeled_data = convert_raw_to_model(results).model_dump()
+    result_publisher.publish(modeled_data) # Публикация результата в очередь сообщений
+    return modeled_data
+
+def submit_job(kind: str, runner) -> dict:
     try:
-        connection = await aio_pika.connect_robust(settings.message_queue_url)
-        channel = await connection.channel()
-        await channel.default_exchange.publish(
-            aio_pika.Message(body=json.dumps(result).encode()),
-            routing_key="analysis_results",
-        )
-        await connection.close()
-        logger.info("The result was successfully sent to the message queue")
-    except Exception as e:
-        logger.error(f"Error sending to queue: {str(e)}")
+        job = job_manager.submit(kind, runner)
+    except OverflowError:
+        logger.warning(f"POST /api/jobs/{kind} - Job queue is full")
+        raise HTTPException(status_code=503, detail="Job queue is full, try again later")
+    return {
+        "jobId": job.id,
+        "status": job.status,
+        "statusUrl": f"/api/jobs/{job.id}",
+        "eventsUrl": f"/api/jobs/{job.id}/events",
+        "websocketUrl": f"/api/jobs/{job.id}/ws",
+    }
+
+@app.post("/api/jobs/multiple", status_code=202)
+async def submit_multiple_job(toolset: str = Form(...), files: List[UploadFile] = File(...)):
+    """Фоновая обработка нескольких изображений: ответ с id задачи сразу после загрузки"""
+    logger.info(f"POST /api/jobs/multiple - Job for {len(files)} images. Toolset: {toolset}")
+
+    valid_extensions = ['.png', '.jpg', '.jpeg', '.gif', '.bmp']
+    sources = []
+    for file in files:
+        if not file.filename or not any(file.filename.lower().endswith(ext) for ext in valid_extensions):
+            logger.warning(f"POST /api/jobs/multiple - Invalid file missing: {file.filename}")
+            continue
+        sources.append((file.filename, await file.read()))
 
+    if not sources:
+        raise HTTPException(status_code=400, detail="No valid images provided")
+
+    async def runner(job: Job):
+        job.total = len(sources)
+        return await run_recognition_job(job, toolset, sources)
+
+    return submit_job("multiple", runner)
+
+@app.post("/api/jobs/archive", status_code=202)
+async def submit_archive_job(toolset: str = Form(...), file: UploadFile = File(...)):
+    """Фоновая обработка архива: архив сохраняется во временный файл, ответ с id задачи"""
+    logger.info(f"POST /api/jobs/archive - Archive job. Toolset: {toolset}, File: {file.filename}")
+
+    if not file or not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    if not file.filename.lower().endswith('.zip'):
+        raise HTTPException(status_code=400, detail="File must be a ZIP archive")
+
+    # Буфер загрузки закрывается вместе с запросом, поэтому архив копируется во временный файл
+    archive = tempfile.TemporaryFile()
+    try:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, archive)
+        archive.seek(0)
+        zip_ref = zipfile.ZipFile(archive, 'r')
+    except zipfile.BadZipFile:
+        archive.close()
+        raise HTTPException(status_code=400, detail="File is not a valid ZIP archive")
+    except Exception:
+        archive.close()
+        raise
+
+    async def runner(job: Job):
+        try:
+            job.total = len(archive_image_members(zip_ref))
+            return await run_recognition_job(job, toolset, iter_archive_images(zip_ref), archive_name=file.filename)
+        finally:
+            zip_ref.close()
+            archive.close()
+
+    try:
+        return submit_job("archive", runner)
+    except HTTPException:
+        zip_ref.close()
+        archive.close()
+        raise
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Состояние задачи; после завершения - итоговая RecognitionOperationModel в поле result"""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.describe()
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request, since: int = Query(0, ge=0)):
+    """
+    Ход задачи в формате Server-Sent Events: status, image (результат изображения), done/failed.
+    При переподключении EventSource передает Last-Event-ID - события продолжаются с него.
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    last_event_id = request.headers.get("last-event-id")
+    start = int(last_event_id) + 1 if last_event_id and last_event_id.isdigit() else since
+
+    async def event_stream():
+        async for event in job.events_from(start, heartbeat=settings.job_heartbeat_seconds):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/api/jobs/{job_id}/ws")
+async def job_events_websocket(websocket: WebSocket, job_id: str, since: int = 0):
+    """Ход задачи через WebSocket: те же события, что и в SSE, в виде JSON-сообщений"""
+    job = job_manager.get(job_id)
+    await websocket.accept()
+    if job is None:
+        await websocket.close(code=4404, reason="Job not found")
+        return
+    try:
+        async for event in job.events_from(since, heartbeat=settings.job_heartbeat_seconds):
+            if event is None:
+                await websocket.send_json({"type": "heartbeat"})
+                continue
+            await websocket.send_json(event)
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info(f"Job {job_id} - WebSocket client disconnected")
+
+@app.get("/api/render/{result_id}")
+async def render_result(result_id: str, size: Optional[int] = Query(None, ge=16, le=8192)):
+    """Изображение с рамками для результата, распознанного в ленивом режиме"""
+    logger.info(f"GET /api/render/{result_id} - Request for overlay, size: {size}")
+    image = await overlay_store.get(result_id, size)
+    if image is None:
+        logger.warning(f"GET /api/render/{result_id} - Result not found")
+        raise HTTPException(status_code=404, detail="Result not found")
+    return Response(content=image, media_type="image/jpeg")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Статистика кэша детекций и кэша отрисованных изображений"""
+    logger.info("GET /api/cache/stats - Request for cache statistics")
+    return {
+        "detections": detection_cache.stats() if detection_cache is not None else None,
+        "overlays": overlay_store.cache.stats(),
+    }
+
+@app.get("/api/admission/stats")
+async def get_admission_stats():
+    """Загрузка инференса: занятые слоты, длина очередей и время ожидания по полосам"""
+    return {"admission": admission.stats(), "jobs": job_manager.stats(), "publisher": result_publisher.stats()}
+
+@app.get("/api/models")
+async def list_model_versions():
+    """Версии весов в реестре и активная версия"""
+    return model_registry.overview()
+
+@app.post("/api/models/register")
+async def register_model_version(version: str = Form(...), model1: str = Form(...), model2: str = Form(...),
+                                 extra_models: Optional[str] = Form(None)):
+    """Регистрация версии из файлов весов в DATA_DIR/models (extra_models - через запятую)"""
+    model_files = [model1, model2, *[name.strip() for name in (extra_models or "").split(",") if name.strip()]]
+    try:
+        entry = model_registry.register(version, model_files)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"POST /api/models/register - Version {version} registered")
+    return entry
+
+@app.post("/api/models/{version}/activate")
+async def activate_model_version(version: str):
+    """Загрузка и прогрев версии в фоне с последующей атомарной заменой активной модели"""
+    logger.info(f"POST /api/models/{version}/activate - Loading model version")
+    try:
+        entry = await model_registry.activate(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Version not found")
+    except Exception as e:
+        logger.error(f"POST /api/models/{version}/activate - Error loading version: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to load version: {str(e)}")
+    logger.info(f"POST /api/models/{version}/activate - Version is active")
+    return entry
 
 def convert_raw_to_model(raw_data_list: List[dict]) -> RecognitionOperationModel:
     """
@@ -252,6 +673,8 @@ def convert_raw_to_model(raw_data_list: List[dict]) -> RecognitionOperationModel
         file_name = raw_data.get("file_name", "")
         image_path = raw_data.get("image_path", "")
         image_base64 = raw_data.get("image_base64", "")
+        inference_path = raw_data.get("inference_path", "")
+        image_hash = raw_data.get("image_hash", "")
         toolset = raw_data.get("toolset", "")
 
         if detections:
@@ -279,7 +702,9 @@ def convert_raw_to_model(raw_data_list: List[dict]) -> RecognitionOperationModel
             detectionTime=processing_time,
             imageConfidence=avg_confidence,
             results=results,
-            imageBase64=image_base64
+            imageBase64=image_base64,
+            inferencePath=inference_path,
+            imageHash=image_hash
         )
 
         images.append(image_model)
@@ -0,0 +1,156 @@
+# app/models/admission.py
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+import numpy as np
+
+# Одиночные проверки на выдаче инструмента и массовая обработка (несколько изображений, архивы, задачи)
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+
+class Overloaded(Exception):
+    def __init__(self, lane: str, reason: str, status_code: int, retry_after: int):
+        """Запрос не допущен к инференсу: очередь полосы заполнена (429) или ожидание превысило лимит (503)"""
+        super().__init__(f"{lane} lane: {reason}")
+        self.lane = lane
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, slots: int = 4, bulk_slots: int = 2, queue_limits: Optional[Dict[str, int]] = None,
+                 timeouts: Optional[Dict[str, float]] = None):
+        """
+        Ограничение числа одновременных распознаваний с очередями по приоритету.
+        Массовые запросы занимают не больше bulk_slots из slots, поэтому для одиночных
+        проверок всегда остается свободная емкость; освободившийся слот первым получает
+        ожидающий интерактивный запрос. Сверх лимита очереди запрос сразу отклоняется.
+        Args:
+            slots: число распознаваний, выполняемых одновременно
+            bulk_slots: сколько из них может занять полоса bulk
+            queue_limits: максимальная длина очереди по полосам
+            timeouts: максимальное ожидание в очереди по полосам, с
+        """
+        self.slots = max(1, int(slots))
+        self.bulk_slots = min(self.slots, max(1, int(bulk_slots)))
+        self.queue_limits = {LANE_INTERACTIVE: 32, LANE_BULK: 8, **(queue_limits or {})}
+        self.timeouts = {LANE_INTERACTIVE: 10.0, LANE_BULK: 120.0, **(timeouts or {})}
+
+        self.active = {lane: 0 for lane in LANES}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {lane: deque() for lane in LANES}
+        # Метрики: последние времена ожидания, среднее время обслуживания (для Retry-After)
+        self._waits: Dict[str, Deque[float]] = {lane: deque(maxlen=1000) for lane in LANES}
+        self._service_time = {lane: 1.0 for lane in LANES}
+        self._counters = {lane: {"admitted": 0, "rejected": 0, "timed_out": 0} for lane in LANES}
+
+    def capacity(self, lane: str) -> int:
+        return self.slots if lane == LANE_INTERACTIVE else self.bulk_slots
+
+    def queued(self, lane: str) -> int:
+        return sum(1 for waiter in self._waiters[lane] if not waiter.done())
+
+    def check(self, lane: str):
+        """Быстрый отказ без постановки в очередь (например, до начала потокового ответа)"""
+        if not self._can_start(lane) and self.queued(lane) >= self.queue_limits[lane]:
+            self._counters[lane]["rejected"] += 1
+            raise Overloaded(lane, "queue is full", 429, self.retry_after(lane))
+
+    @asynccontextmanager
+    async def admit(self, lane: str, bounded: bool = True) -> AsyncIterator[None]:
+        """
+        Слот на время распознавания.
+        bounded=False - ждать без лимита очереди и таймаута (фоновые задачи, у которых своя очередь).
+        """
+        await self.acquire(lane, bounded)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._service_time[lane] = 0.8 * self._service_time[lane] + 0.2 * elapsed
+            self.release(lane)
+
+    async def acquire(self, lane: str, bounded: bool = True):
+        if not self._waiters[lane] and self._can_start(lane):
+            self._grant(lane)
+            self._waits[lane].append(0.0)
+            return
+
+        if bounded:
+            self.check(lane)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeouts[lane] if bounded else None)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # Слот выдан одновременно с таймаутом/отменой - возвращаем его
+                self.release(lane)
+            else:
+                waiter.cancel()
+            self._discard(lane, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self._counters[lane]["timed_out"] += 1
+                raise Overloaded(lane, "queue wait timed out", 503, self.retry_after(lane))
+            raise
+        self._waits[lane].append(time.perf_counter() - started)
+
+    def release(self, lane: str):
+        self.active[lane] -= 1
+        self._wake()
+
+    def retry_after(self, lane: str) -> int:
+        """Оценка, через сколько секунд очередь полосы продвинется: очередь / емкость * среднее время"""
+        backlog = self.queued(lane) + 1
+        return max(1, math.ceil(backlog / self.capacity(lane) * self._service_time[lane]))
+
+    def stats(self) -> dict:
+        lanes = {}
+        for lane in LANES:
+            waits = np.array(self._waits[lane]) * 1000 if self._waits[lane] else np.zeros(1)
+            lanes[lane] = {
+                "active": self.active[lane],
+                "queued": self.queued(lane),
+                "capacity": self.capacity(lane),
+                "queue_limit": self.queue_limits[lane],
+                **self._counters[lane],
+                "wait_ms_avg": round(float(waits.mean()), 1),
+                "wait_ms_p95": round(float(np.percentile(waits, 95)), 1),
+                "wait_ms_max": round(float(waits.max()), 1),
+                "service_s_avg": round(self._service_time[lane], 3),
+            }
+        return {"slots": self.slots, "active": sum(self.active.values()), "lanes": lanes}
+
+    def _can_start(self, lane: str) -> bool:
+        if sum(self.active.values()) >= self.slots:
+            return False
+        return lane == LANE_INTERACTIVE or self.active[LANE_BULK] < self.bulk_slots
+
+    def _grant(self, lane: str):
+        self.active[lane] += 1
+        self._counters[lane]["admitted"] += 1
+
+    def _wake(self):
+        """Свободные слоты - ожидающим, интерактивная полоса первой"""
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            while waiters and self._can_start(lane):
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                self._grant(lane)
+                waiter.set_result(None)
+
+    def _discard(self, lane: str, waiter: asyncio.Future):
+        try:
+            self._waiters[lane].remove(waiter)
+        except ValueError:
+            pass
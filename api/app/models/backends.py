@@ -0,0 +1,317 @@
+# app/models/backends.py
+import argparse
+import ast
+import logging
+import queue
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+from torchvision.ops import batched_nms
+from ultralytics import YOLO
+
+from app.models.merger import iou_matrix
+from app.models.preprocessing import PreparedImage, prepare_images, stack, to_image_coordinates
+
+logger = logging.getLogger(__name__)
+
+# Сырые детекции одного изображения: боксы (N, 4) xyxy, уверенности (N,), id классов модели (N,)
+RawDetections = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+# Параметры постобработки ultralytics по умолчанию - для совпадения с PyTorch-бэкендом
+NMS_CONFIDENCE = 0.25
+NMS_IOU = 0.7
+MAX_DETECTIONS = 300
+
+
+def _model_imgsz(model) -> int:
+    """Размер входа, с которым модель обучалась (ultralytics сохраняет его в весах)"""
+    imgsz = model.overrides.get("imgsz") or 640
+    return int(imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz)
+
+
+def _metadata_imgsz(metadata: dict) -> Optional[int]:
+    imgsz = metadata.get("imgsz")
+    if imgsz is None:
+        return None
+    return int(imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz)
+
+
+def trained_imgsz(weights_path: str) -> Optional[int]:
+    """Размер входа из чекпойнта; None - весов .pt нет (есть только экспортированная модель)"""
+    if not Path(weights_path).exists():
+        return None
+    return _model_imgsz(YOLO(weights_path))
+
+
+class UltralyticsBackend:
+    def __init__(self, weights_path: str):
+        """Исходный бэкенд: модель ultralytics на PyTorch (одна модель, проходы последовательны)"""
+        self.weights_path = weights_path
+        self.model = YOLO(weights_path)
+        self.names: Dict[int, str] = self.model.names
+        self.imgsz = _model_imgsz(self.model)
+        self.pool_size = 1
+
+    def predict(self, images: List[Image.Image]) -> List[RawDetections]:
+        return self.predict_prepared(prepare_images(images, self.imgsz))
+
+    def predict_prepared(self, prepared: List[PreparedImage]) -> List[RawDetections]:
+        """Проход по готовым входам: ultralytics пропускает свою предобработку для тензора"""
+        outputs = []
+        for result, item in zip(self.model(torch.from_numpy(stack(prepared)), verbose=False), prepared):
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                outputs.append((np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)))
+                continue
+            outputs.append((
+                to_image_coordinates(boxes.xyxy.cpu().numpy(), item),
+                boxes.conf.cpu().numpy(),
+                boxes.cls.cpu().numpy().astype(np.int64),
+            ))
+        return outputs
+
+
+class _OnnxSession:
+    def __init__(self, path: Path, threads: int = 0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("onnxruntime is not installed") from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.metadata = {
+            key: ast.literal_eval(value) if key in ("names", "imgsz") else value
+            for key, value in self.session.get_modelmeta().custom_metadata_map.items()
+        }
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class _OpenVinoSession:
+    # Одна скомпилированная модель на все сессии пула, у каждой сессии - свой infer request
+    _compiled: Dict[Tuple[str, int], object] = {}
+
+    def __init__(self, path: Path, threads: int = 0):
+        try:
+            import openvino as ov
+        except ImportError as e:
+            raise RuntimeError("openvino is not installed") from e
+
+        key = (str(path), threads)
+        if key not in self._compiled:
+            config = {"PERFORMANCE_HINT": "LATENCY"}
+            if threads > 0:
+                config["INFERENCE_NUM_THREADS"] = threads
+            core = ov.Core()
+            self._compiled[key] = core.compile_model(core.read_model(str(path)), "CPU", config)
+        self.request = self._compiled[key].create_infer_request()
+        with open(path.parent / "metadata.yaml", 'r', encoding='utf-8') as file:
+            self.metadata = yaml.safe_load(file)
+
+    def run(self, batch: np.ndarray) -> np.ndarray:
+        self.request.infer({0: batch})
+        return self.request.get_output_tensor(0).data.copy()
+
+
+# INT8-варианты создаются конвейером квантизации app3.quantize, а не экспортом при запуске
+RUNTIMES = {
+    "onnx": _OnnxSession,
+    "onnx-int8": _OnnxSession,
+    "openvino": _OpenVinoSession,
+    "openvino-int8": _OpenVinoSession,
+}
+
+
+def artifact_path(weights_path: str, runtime: str) -> Path:
+    """Путь экспортированной модели рядом с весами (по соглашению ultralytics export)"""
+    weights = Path(weights_path)
+    if runtime == "onnx":
+        return weights.with_suffix(".onnx")
+    if runtime == "onnx-int8":
+        return weights.with_name(f"{weights.stem}_int8.onnx")
+    if runtime == "openvino-int8":
+        return weights.parent / f"{weights.stem}_int8_openvino_model" / f"{weights.stem}.xml"
+    return weights.parent / f"{weights.stem}_openvino_model" / f"{weights.stem}.xml"
+
+
+def export_artifact(weights_path: str, runtime: str, imgsz: Optional[int] = None, force: bool = False) -> Path:
+    """
+    Экспорт весов в формат runtime один раз: готовый артефакт рядом с весами
+    используется повторно, пока он не старше самих весов.
+    imgsz - размер входа экспорта; по умолчанию тот, с которым модель обучалась,
+    чтобы letterbox совпадал с PyTorch-бэкендом.
+    """
+    target = artifact_path(weights_path, runtime)
+    weights = Path(weights_path)
+    if not force and target.exists() and (not weights.exists() or target.stat().st_mtime >= weights.stat().st_mtime):
+        return target
+
+    if runtime.endswith("-int8"):
+        raise FileNotFoundError(f"INT8 model {target} not found, run the quantization pipeline (app3.quantize) first")
+
+    model = YOLO(weights_path)
+    imgsz = imgsz or _model_imgsz(model)
+    logger.info(f"Exporting {weights_path} to {runtime} (imgsz {imgsz})")
+    exported = model.export(format=runtime, dynamic=True, imgsz=imgsz)
+    if runtime == "openvino":
+        exported = Path(exported) / target.name
+    return Path(exported)
+
+
+def postprocess(prediction: np.ndarray, prepared: PreparedImage, conf: float = NMS_CONFIDENCE, iou: float = NMS_IOU, max_det: int = MAX_DETECTIONS) -> RawDetections:
+    """
+    Выход головы YOLOv8 (4 + nc, N) -> детекции в координатах исходного изображения.
+    Порог уверенности и class-aware NMS - как в ultralytics.
+    """
+    prediction = prediction.T
+    class_scores = prediction[:, 4:]
+    class_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(class_scores)), class_ids]
+    keep = scores > conf
+    xywh, scores, class_ids = prediction[keep, :4], scores[keep], class_ids[keep]
+
+    boxes = np.empty_like(xywh)
+    boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+    boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+
+    keep = batched_nms(torch.from_numpy(boxes), torch.from_numpy(scores), torch.from_numpy(class_ids), iou)
+    keep = keep[:max_det].numpy()
+    boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+
+    return to_image_coordinates(boxes, prepared), scores, class_ids.astype(np.int64)
+
+
+class RuntimeBackend:
+    def __init__(self, weights_path: str, runtime: str = "onnx", pool_size: int = 2, threads: int = 0):
+        """
+        Инференс экспортированной модели (ONNX Runtime или OpenVINO) на CPU.
+        Держит пул сессий: батчи одной модели могут выполняться параллельно,
+        каждая сессия в каждый момент обслуживает только один батч.
+        Args:
+            weights_path: путь к весам .pt (артефакт экспорта кэшируется рядом)
+            runtime: "onnx", "openvino" или их INT8-варианты "onnx-int8", "openvino-int8"
+            pool_size: число сессий
+            threads: потоков на сессию (0 - по умолчанию runtime)
+        """
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown inference runtime: {runtime}")
+        self.weights_path = weights_path
+        self.runtime = runtime
+        self.pool_size = max(1, int(pool_size))
+        # Вход и letterbox - как у PyTorch-бэкенда: размер обучения из чекпойнта
+        trained = trained_imgsz(weights_path)
+        self.artifact = export_artifact(weights_path, runtime, imgsz=trained)
+
+        session = RUNTIMES[runtime](self.artifact, threads)
+        exported = _metadata_imgsz(session.metadata)
+        if trained is not None and exported is not None and exported != trained:
+            if runtime.endswith("-int8"):
+                raise ValueError(f"{self.artifact} was built for imgsz {exported}, the model is trained at {trained}; "
+                                 f"re-run the quantization pipeline")
+            logger.warning(f"{self.artifact} was exported at imgsz {exported}, re-exporting at {trained}")
+            self.artifact = export_artifact(weights_path, runtime, imgsz=trained, force=True)
+            _OpenVinoSession._compiled.pop((str(self.artifact), threads), None)
+            session = RUNTIMES[runtime](self.artifact, threads)
+
+        self._sessions: "queue.Queue" = queue.Queue()
+        self._sessions.put(session)
+        for _ in range(self.pool_size - 1):
+            self._sessions.put(RUNTIMES[runtime](self.artifact, threads))
+        metadata = session.metadata
+        self.names: Dict[int, str] = {int(k): v for k, v in metadata["names"].items()}
+        self.imgsz = trained or _metadata_imgsz(metadata) or 640
+        logger.info(f"Loaded {self.artifact} ({runtime}, {self.pool_size} sessions)")
+
+    def predict(self, images: List[Image.Image]) -> List[RawDetections]:
+        return self.predict_prepared(prepare_images(images, self.imgsz))
+
+    def predict_prepared(self, prepared: List[PreparedImage]) -> List[RawDetections]:
+        batch = stack(prepared)
+        session = self._sessions.get()
+        try:
+            predictions = session.run(batch)
+        finally:
+            self._sessions.put(session)
+
+        return [postprocess(prediction, item) for prediction, item in zip(predictions, prepared)]
+
+
+def create_backend(weights_path: str, backend: str = "torch", pool_size: int = 2, threads: int = 0):
+    """
+    Бэкенд инференса по имени. Если экспорт или загрузка runtime не удались,
+    модель обслуживается исходным PyTorch-бэкендом.
+    """
+    if backend == "torch":
+        return UltralyticsBackend(weights_path)
+    try:
+        return RuntimeBackend(weights_path, backend, pool_size, threads)
+    except Exception as e:
+        logger.error(f"Failed to initialize {backend} backend for {weights_path}, falling back to torch: {str(e)}")
+        return UltralyticsBackend(weights_path)
+
+
+def parity_report(backend, reference, images: List[Image.Image], iou_threshold: float = 0.9,
+                  score_tolerance: float = 0.05) -> dict:
+    """
+    Сравнение выходов бэкенда с эталонным (PyTorch) на одних изображениях.
+    Бокс эталона совпал, если у бэкенда есть бокс того же класса с IoU >= iou_threshold
+    и разницей уверенности не больше score_tolerance.
+    """
+    reference_boxes = matched = extra = 0
+    max_score_diff = 0.0
+    for image in images:
+        boxes, scores, classes = backend.predict([image])[0]
+        ref_boxes, ref_scores, ref_classes = reference.predict([image])[0]
+        reference_boxes += len(ref_boxes)
+        extra += max(0, len(boxes) - len(ref_boxes))
+        if not len(ref_boxes) or not len(boxes):
+            continue
+
+        ious = iou_matrix(ref_boxes, boxes)
+        ious[ref_classes[:, None] != classes[None, :]] = 0
+        best = ious.argmax(axis=1)
+        best_iou = ious[np.arange(len(ref_boxes)), best]
+        score_diff = np.abs(ref_scores - scores[best])
+        hit = (best_iou >= iou_threshold) & (score_diff <= score_tolerance)
+        matched += int(hit.sum())
+        if hit.any():
+            max_score_diff = max(max_score_diff, float(score_diff[hit].max()))
+
+    match_rate = matched / reference_boxes if reference_boxes else 1.0
+    return {
+        "images": len(images),
+        "reference_boxes": reference_boxes,
+        "matched": matched,
+        "extra_boxes": extra,
+        "match_rate": round(match_rate, 4),
+        "max_score_diff": round(max_score_diff, 4),
+        "passed": match_rate >= 0.98,
+    }
+
+
+if __name__ == "__main__":
+    # Проверка совпадения: python -m app.models.backends --weights app/model1.pt --runtime onnx --images <каталог>
+    parser = argparse.ArgumentParser(description="Parity check of an exported model against PyTorch")
+    parser.add_argument("--weights", required=True)
+    parser.add_argument("--runtime", choices=sorted(RUNTIMES), default="onnx")
+    parser.add_argument("--images", required=True)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    paths = sorted(p for p in Path(args.images).rglob("*") if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".bmp"))
+    sample = [Image.open(p).convert('RGB') for p in paths[:args.limit]]
+    report = parity_report(RuntimeBackend(args.weights, args.runtime, pool_size=1), UltralyticsBackend(args.weights), sample)
+    print(report)
+    raise SystemExit(0 if report["passed"] else 1)
@@ -0,0 +1,167 @@
+# app/models/batcher.py
+import asyncio
+import logging
+from typing import Any, Callable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    def __init__(self, infer: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 window_ms: float = 5.0, name: str = "model", concurrency: int = 1):
+        """
+        Планировщик микробатчей перед одной моделью.
+        Собирает изображения из конкурентных запросов в течение окна window_ms
+        (но не больше max_batch_size), выполняет один батчевый проход модели
+        в отдельном потоке и раздаёт результаты ожидающим запросам.
+        Args:
+            infer: функция, принимающая список изображений и возвращающая список результатов того же размера
+            max_batch_size: максимальный размер батча
+            window_ms: окно ожидания дополнительных изображений после первого, мс
+            name: имя для логов
+            concurrency: число батчей, выполняемых одновременно (размер пула сессий модели)
+        """
+        self._infer = infer
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.window = max(0.0, float(window_ms)) / 1000
+        self.name = name
+        self.concurrency = max(1, int(concurrency))
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Выполняющиеся батчи (при concurrency > 1): event loop хранит задачи только по слабой ссылке
+        self._running: Set[asyncio.Task] = set()
+        # Группа, не поместившаяся в предыдущий батч; открывает следующий
+        self._carry = None
+
+        # Счетчики для оценки эффективности батчинга
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        """Поставить изображение в очередь и дождаться результата его батча"""
+        results = await self.submit_many([item])
+        return results[0]
+
+    async def submit_many(self, items: List[Any]) -> List[Any]:
+        """
+        Поставить группу изображений одним элементом очереди.
+        Группа не разбивается между проходами, поэтому явные батчи
+        (несколько файлов, архив) идут в модель целиком.
+        """
+        if not items:
+            return []
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((list(items), future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+        }
+
+    def close(self):
+        """
+        Остановка воркера и выполняющихся батчей; ожидающие в очереди и в отмененных
+        батчах получают ошибку, а не зависают. Новые группы снова запустят воркер.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for task in list(self._running):
+            task.cancel()
+
+        error = RuntimeError(f"Batcher {self.name} is closed")
+        pending = [self._carry] if self._carry is not None else []
+        self._carry = None
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+    def _ensure_worker(self):
+        # Воркер создается лениво, т.к. детектор инициализируется до запуска event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._carry = None
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._worker = asyncio.create_task(self._run())
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        if self._carry is not None:
+            batch, self._carry = [self._carry], None
+        else:
+            batch = [await self._queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.window
+
+        while size < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                # Окно закрыто: забираем только то, что уже стоит в очереди
+                try:
+                    group = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            else:
+                try:
+                    group = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if size + len(group[0]) > self.max_batch_size:
+                self._carry = group
+                break
+            batch.append(group)
+            size += len(group[0])
+        return batch
+
+    async def _run(self):
+        while True:
+            # Следующий батч собирается, только когда освободилась сессия модели
+            await self._slots.acquire()
+            batch = await self._collect()
+            # Запросы, которые уже отменены клиентом, не гоняем через модель
+            batch = [(group, future) for group, future in batch if not future.done()]
+            if not batch:
+                self._slots.release()
+                continue
+            if self.concurrency == 1:
+                await self._execute(batch)
+            else:
+                task = asyncio.create_task(self._execute(batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch: list):
+        try:
+            items = [item for group, _ in batch for item in group]
+            try:
+                results = await asyncio.to_thread(self._infer, items)
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError(f"Batcher {self.name} is closed"))
+                raise
+            except Exception as e:
+                logger.error(f"Batch inference error ({self.name}, size {len(items)}): {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            self.batches += 1
+            self.items += len(items)
+            offset = 0
+            for group, future in batch:
+                if not future.done():
+                    future.set_result(results[offset:offset + len(group)])
+                offset += len(group)
+        finally:
+            self._slots.release()
@@ -0,0 +1,71 @@
+# app/models/cache.py
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = len):
+        """
+        LRU-кэш в памяти с ограничением по числу записей и/или суммарному размеру.
+        Args:
+            max_entries: максимальное число записей (None - без ограничения)
+            max_bytes: максимальный суммарный размер значений (None - без ограничения)
+            sizeof: функция оценки размера значения
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            # Значение больше всего кэша не храним, чтобы не вытеснять всё остальное
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._items[key] = value
+            self._sizes[key] = size
+            self.total_bytes += size
+
+            while self._items and (
+                (self.max_entries is not None and len(self._items) > self.max_entries)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._items),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: Hashable):
+        del self._items[key]
+        self.total_bytes -= self._sizes.pop(key)
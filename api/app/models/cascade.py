@@ -0,0 +1,57 @@
+# app/models/cascade.py
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+from app.models.detections import Detections
+from app.models.merger import iou_matrix
+
+# Пути инференса, которые попадают в ответ
+PATH_PARALLEL = "ensemble"
+PATH_PRIMARY = "model1"
+PATH_ESCALATED = "model1+ensemble"
+PATH_CACHE = "cache"
+
+
+@dataclass
+class CascadeRules:
+    """
+    Правила, по которым детекции первой модели считаются неоднозначными
+    и изображение отправляется на полный ансамбль.
+    low_confidence/high_confidence - полоса сомнительной уверенности: детекции
+    ниже low считаются шумом, выше high - уверенными.
+    conflict_iou - пересечение боксов разных классов, при котором классы конфликтуют (0 - не проверять).
+    expected_count - ожидаемое число инструментов на снимке (0 - не проверять).
+    """
+    low_confidence: float = 0.3
+    high_confidence: float = 0.7
+    conflict_iou: float = 0.5
+    expected_count: int = 0
+
+    def key(self) -> tuple:
+        """Параметры правил для ключа кэша детекций"""
+        return (self.low_confidence, self.high_confidence, self.conflict_iou, self.expected_count)
+
+
+def ambiguity_reasons(detections: Detections, rules: CascadeRules) -> List[str]:
+    """
+    Причины отправить изображение на полный ансамбль; пустой список - результата первой модели достаточно.
+    """
+    reasons = []
+    scores = detections.scores
+    relevant = detections.select(scores >= rules.low_confidence)
+
+    if (relevant.scores < rules.high_confidence).any():
+        reasons.append("low_confidence")
+
+    if rules.conflict_iou > 0 and len(relevant) > 1:
+        overlaps = iou_matrix(relevant.boxes, relevant.boxes) >= rules.conflict_iou
+        different = relevant.classes[:, None] != relevant.classes[None, :]
+        if (overlaps & different).any():
+            reasons.append("class_conflict")
+
+    if rules.expected_count > 0 and int((scores >= rules.high_confidence).sum()) != rules.expected_count:
+        reasons.append("count_mismatch")
+
+    return reasons
@@ -0,0 +1,90 @@
+# app/models/decoding.py
+import hashlib
+import math
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# Путь к файлу, закодированное изображение в памяти, файловый объект или массив HxWx3 (RGB)
+ImageSource = Union[str, Path, bytes, bytearray, memoryview, BinaryIO, np.ndarray, Image.Image]
+
+
+@dataclass
+class DecodedImage:
+    """
+    Декодированное изображение для инференса.
+    encoded - исходные байты файла, если они есть: их дешевле передать
+    в процесс отрисовки, чем сериализовать пиксели.
+    original_size - размер исходного изображения, scale - множители (x, y) перевода
+    координат image в исходные (image может быть декодировано с уменьшением).
+    """
+    image: Image.Image
+    encoded: Optional[bytes] = None
+    digest: Optional[str] = None
+    original_size: Optional[Tuple[int, int]] = None
+    scale: Tuple[float, float] = (1.0, 1.0)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.original_size or self.image.size
+
+    def content_digest(self) -> str:
+        """Хэш содержимого: байтов файла, а для массивов - пикселей"""
+        if self.digest is None:
+            digest = hashlib.blake2b(digest_size=20)
+            if self.encoded is not None:
+                digest.update(self.encoded)
+            else:
+                digest.update(f"{self.image.mode}{self.image.size}".encode())
+                digest.update(self.image.tobytes())
+            self.digest = digest.hexdigest()
+        return self.digest
+
+
+def read_encoded(source: ImageSource) -> Optional[bytes]:
+    """Байты закодированного изображения; None для уже декодированных источников"""
+    if isinstance(source, (Image.Image, np.ndarray)):
+        return None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, (str, Path)):
+        with open(source, 'rb') as file:
+            return file.read()
+    # Файловый объект (UploadFile.file, член zip-архива)
+    return source.read()
+
+
+def decode_image(source: ImageSource, target_size: Optional[int] = None) -> DecodedImage:
+    """
+    Декодирование изображения без промежуточных файлов на диске.
+    target_size - сторона входа модели: JPEG крупнее декодируется сразу с уменьшением
+    в 2, 4 или 8 раз (масштабирование в DCT-области), но не меньше target_size
+    по длинной стороне. Полное разрешение нужно только для отрисовки - она декодирует encoded заново.
+    """
+    if isinstance(source, Image.Image):
+        return DecodedImage(source.convert('RGB'))
+    if isinstance(source, np.ndarray):
+        return DecodedImage(Image.fromarray(source).convert('RGB'))
+
+    encoded = read_encoded(source)
+    image = Image.open(BytesIO(encoded))
+    original_size = image.size
+    if target_size and image.format == "JPEG" and max(original_size) > target_size:
+        width, height = original_size
+        ratio = target_size / max(width, height)
+        image.draft('RGB', (math.ceil(width * ratio), math.ceil(height * ratio)))
+    image = image.convert('RGB')
+    scale = (original_size[0] / image.width, original_size[1] / image.height)
+    return DecodedImage(image, encoded, original_size=original_size, scale=scale)
+
+
+def source_name(source: ImageSource) -> Optional[str]:
+    if isinstance(source, (str, Path)):
+        return str(source)
+    # У файловых объектов name бывает числом (дескриптор) или отсутствует
+    name = getattr(source, "name", None)
+    return name if isinstance(name, str) else None
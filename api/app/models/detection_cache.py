@@ -0,0 +1,139 @@
+# app/models/detection_cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from app.models.cache import LRUCache
+from app.models.detections import Detections
+
+logger = logging.getLogger(__name__)
+
+
+def weights_fingerprint(paths: Iterable[str]) -> str:
+    """Идентичность загруженных весов: хэш содержимого файлов моделей"""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        try:
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+        except OSError:
+            # Веса загружены не из файла (например, по имени из хаба ultralytics)
+            digest.update(str(path).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    def __init__(self, max_entries: int = 2048, disk_dir: Optional[str] = None, disk_max_entries: int = 100000):
+        """
+        Кэш результатов детекции, адресуемый по содержимому.
+        Ключ - хэш байтов изображения + идентичность весов + параметры объединения,
+        поэтому повторная загрузка того же снимка не запускает модели.
+        Args:
+            max_entries: размер уровня в памяти
+            disk_dir: каталог уровня на диске (None - только память)
+            disk_max_entries: максимальное число записей на диске
+        """
+        self.memory = LRUCache(max_entries=max(1, int(max_entries)))
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_entries = max(1, int(disk_max_entries))
+        # Порядок записей на диске (от старых к новым) для вытеснения
+        self._disk_keys: "OrderedDict[str, None]" = OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            entries = sorted(self.disk_dir.glob("*/*.json"), key=lambda path: path.stat().st_mtime)
+            for path in entries:
+                self._disk_keys[path.stem] = None
+
+    @staticmethod
+    def make_key(image_digest: str, model_fingerprint: str, params: tuple) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(image_digest.encode())
+        digest.update(model_fingerprint.encode())
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+
+    async def get(self, key: str) -> Optional[Detections]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+
+        if self.disk_dir is not None and key in self._disk_keys:
+            value = await asyncio.to_thread(self._disk_read, key)
+            if value is None:
+                self._disk_keys.pop(key, None)
+            else:
+                self.disk_hits += 1
+                self._disk_keys.move_to_end(key)
+                self.memory.put(key, value)
+                return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: Detections):
+        self.memory.put(key, value)
+        if self.disk_dir is None or key in self._disk_keys:
+            return
+
+        self._disk_keys[key] = None
+        evicted = []
+        while len(self._disk_keys) > self.disk_max_entries:
+            oldest, _ = self._disk_keys.popitem(last=False)
+            evicted.append(oldest)
+        if not await asyncio.to_thread(self._disk_write, key, value, evicted):
+            self._disk_keys.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "disk_entries": len(self._disk_keys),
+        }
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _disk_read(self, key: str) -> Optional[Detections]:
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as file:
+                return Detections.from_json(json.load(file))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Detection cache entry {key} is unreadable: {str(e)}")
+            return None
+
+    def _disk_write(self, key: str, value: Detections, evicted: List[str]) -> bool:
+        for old_key in evicted:
+            try:
+                self._disk_path(old_key).unlink()
+            except OSError:
+                pass
+
+        try:
+            path = self._disk_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Запись через временный файл, чтобы читатель не увидел половину записи
+            temp_path = path.with_suffix(".tmp")
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(value.to_json(), file)
+            os.replace(temp_path, path)
+            return True
+        except OSError as e:
+            logger.error(f"Error writing detection cache entry {key}: {str(e)}")
+            return False
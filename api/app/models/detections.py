@@ -0,0 +1,128 @@
+# app/models/detections.py
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+@dataclass
+class Detections:
+    """
+    Колоночное представление детекций одного изображения.
+    boxes - (N, 4) [x1, y1, x2, y2], scores - (N,), classes - (N,) коды классов,
+    names - таблица имен классов: names[code]. Детекции, которые объединяются
+    между собой, должны ссылаться на одну и ту же таблицу имен.
+    """
+    boxes: np.ndarray
+    scores: np.ndarray
+    classes: np.ndarray
+    names: List[str]
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    @classmethod
+    def empty(cls, names: List[str]) -> "Detections":
+        return cls(np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64), names)
+
+    @classmethod
+    def from_arrays(cls, boxes: np.ndarray, scores: np.ndarray, class_ids: np.ndarray,
+                    class_map: np.ndarray, names: List[str]) -> "Detections":
+        """Сырые массивы бэкенда инференса (id классов модели) -> Detections с общей таблицей имен"""
+        return cls(
+            np.asarray(boxes, dtype=np.float64).reshape(-1, 4),
+            np.asarray(scores, dtype=np.float64).reshape(-1),
+            class_map[np.asarray(class_ids).astype(np.int64).reshape(-1)],
+            names,
+        )
+
+    @classmethod
+    def from_dicts(cls, detections: List[Dict[str, Any]], names: List[str]) -> "Detections":
+        """Список словарей {'bbox', 'confidence', 'class'} -> массивы; новые классы дописываются в names"""
+        codes = {name: code for code, name in enumerate(names)}
+        classes = []
+        for det in detections:
+            if det['class'] not in codes:
+                codes[det['class']] = len(names)
+                names.append(det['class'])
+            classes.append(codes[det['class']])
+        return cls(
+            np.array([d['bbox'] for d in detections], dtype=np.float64).reshape(-1, 4),
+            np.array([d['confidence'] for d in detections], dtype=np.float64),
+            np.array(classes, dtype=np.int64),
+            names,
+        )
+
+    @classmethod
+    def concat(cls, parts: Sequence["Detections"], names: List[str]) -> "Detections":
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty(names)
+        return cls(
+            np.concatenate([part.boxes for part in parts]),
+            np.concatenate([part.scores for part in parts]),
+            np.concatenate([part.classes for part in parts]),
+            names,
+        )
+
+    def select(self, index) -> "Detections":
+        """Подмножество по булевой маске или массиву индексов"""
+        return Detections(self.boxes[index], self.scores[index], self.classes[index], self.names)
+
+    def rescaled(self, scale_x: float, scale_y: float) -> "Detections":
+        """Перевод боксов в другой масштаб (например, из уменьшенного декодирования в исходный)"""
+        if scale_x == 1.0 and scale_y == 1.0:
+            return self
+        factors = np.array([scale_x, scale_y, scale_x, scale_y])
+        return Detections(self.boxes * factors, self.scores, self.classes, self.names)
+
+    def to_dicts(self, class_colors: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+        """Словари создаются только на границе JSON-ответа"""
+        names = [self.names[code] for code in self.classes.tolist()]
+        dicts = [
+            {'bbox': bbox, 'confidence': confidence, 'class': name}
+            for bbox, confidence, name in zip(self.boxes.tolist(), self.scores.tolist(), names)
+        ]
+        if class_colors is not None:
+            for det in dicts:
+                det['color'] = class_colors.get(det['class'], "#000000")
+        return dicts
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "names": list(self.names),
+            "boxes": self.boxes.tolist(),
+            "scores": self.scores.tolist(),
+            "classes": self.classes.tolist(),
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Detections":
+        return cls(
+            np.array(data["boxes"], dtype=np.float64).reshape(-1, 4),
+            np.array(data["scores"], dtype=np.float64),
+            np.array(data["classes"], dtype=np.int64),
+            list(data["names"]),
+        )
+
+
+def build_class_table(model_names: Sequence[Dict[int, str]]):
+    """
+    Общая таблица классов для ансамбля.
+    Returns:
+        names - список имен (код -> имя), class_maps - для каждой модели массив id модели -> код
+    """
+    names: List[str] = []
+    codes: Dict[str, int] = {}
+    class_maps = []
+    for local_names in model_names:
+        class_map = np.zeros(max(local_names, default=-1) + 1, dtype=np.int64)
+        for class_id, name in local_names.items():
+            # Классы без имени получают имя по номеру, чтобы в ответ не попал None
+            name = name if name is not None else str(class_id)
+            if name not in codes:
+                codes[name] = len(names)
+                names.append(name)
+            class_map[class_id] = codes[name]
+        class_maps.append(class_map)
+    return names, class_maps
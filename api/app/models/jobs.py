@@ -0,0 +1,216 @@
+# app/models/jobs.py
+import asyncio
+import datetime
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Типы событий задачи
+EVENT_STATUS = "status"
+EVENT_IMAGE = "image"
+EVENT_DONE = "done"
+EVENT_FAILED = "failed"
+
+
+class Job:
+    def __init__(self, job_id: str, kind: str, runner: Callable[["Job"], Awaitable[Any]]):
+        """
+        Фоновая задача распознавания.
+        События (статус, результат каждого изображения, итог) сохраняются по порядку:
+        подписчик, подключившийся позже, сначала получает уже произошедшие события.
+        """
+        self.id = job_id
+        self.kind = kind
+        self.status = JOB_QUEUED
+        self.created = datetime.datetime.now().isoformat()
+        self.finished_at: Optional[float] = None
+        self.total: Optional[int] = None
+        self.processed = 0
+        self.failed_images = 0
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        # Журнал событий; после доставки итогового события от него остается только итог
+        self.events: List[dict] = []
+        self._first_seq = 0
+        self._runner = runner
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (JOB_DONE, JOB_FAILED)
+
+    def emit(self, event_type: str, **data):
+        self.events.append({"type": event_type, "seq": self._first_seq + len(self.events), **data})
+        # Будим всех ждущих подписчиков и сразу готовим событие для следующих
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def image_done(self, image: Optional[dict], **data):
+        """
+        Результат одного изображения; None - изображение не удалось обработать.
+        В событии - только ссылка на отрисовку (imageUrl) и детекции, без base64.
+        """
+        self.processed += 1
+        if image is None:
+            self.failed_images += 1
+        self.emit(EVENT_IMAGE, image=image, processed=self.processed, total=self.total, **data)
+
+    async def events_from(self, start: int = 0, heartbeat: Optional[float] = None) -> AsyncIterator[Optional[dict]]:
+        """
+        События начиная с номера start; поток заканчивается после итогового события.
+        Если за heartbeat секунд новых событий нет, выдается None (keep-alive для прокси).
+        """
+        seq = max(0, start)
+        while True:
+            # Удаленная часть журнала пропускается, итоговое событие остается всегда
+            seq = max(seq, self._first_seq)
+            while seq - self._first_seq < len(self.events):
+                event = self.events[seq - self._first_seq]
+                seq += 1
+                yield event
+            if self.finished:
+                self._compact()
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+
+    def _compact(self):
+        """Итог доставлен подписчику: промежуточные события больше не нужны"""
+        if self.finished and len(self.events) > 1:
+            self._first_seq += len(self.events) - 1
+            self.events = self.events[-1:]
+
+    def describe(self, include_result: bool = True) -> dict:
+        description = {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created": self.created,
+            "total": self.total,
+            "processed": self.processed,
+            "failed": self.failed_images,
+            "error": self.error,
+        }
+        if include_result:
+            description["result"] = self.result
+        return description
+
+
+class JobManager:
+    def __init__(self, workers: int = 2, max_queued: int = 100, ttl_seconds: float = 900, max_finished: int = 200):
+        """
+        Очередь фоновых задач распознавания с фиксированным числом обработчиков.
+        Args:
+            workers: число задач, выполняемых одновременно
+            max_queued: максимум задач в очереди (сверх этого submit отклоняет задачу)
+            ttl_seconds: сколько хранить завершенную задачу и её результат
+            max_finished: максимум хранимых завершенных задач (старые удаляются раньше ttl)
+        """
+        self.workers = max(1, int(workers))
+        self.max_queued = max(1, int(max_queued))
+        self.ttl_seconds = ttl_seconds
+        self.max_finished = max(1, int(max_finished))
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        """Запуск обработчиков (нужен работающий event loop)"""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for job in self.jobs.values():
+            if not job.finished:
+                self._fail(job, "Service is shutting down")
+
+    def submit(self, kind: str, runner: Callable[[Job], Awaitable[Any]]) -> Job:
+        """
+        Постановка задачи в очередь. runner(job) выполняется обработчиком,
+        сообщает о ходе работы через job.image_done и возвращает итоговый результат.
+        """
+        if self._queue is None:
+            raise RuntimeError("Job manager is not started")
+        self._expire()
+        if self._queue.qsize() >= self.max_queued:
+            raise OverflowError("Job queue is full")
+
+        job = Job(uuid.uuid4().hex, kind, runner)
+        self.jobs[job.id] = job
+        job.emit(EVENT_STATUS, status=job.status)
+        self._queue.put_nowait(job)
+        logger.info(f"Job {job.id} ({kind}) queued, {self._queue.qsize()} in queue")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        counts: Dict[str, int] = {}
+        for job in self.jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self._queue.qsize() if self._queue else 0, "jobs": counts}
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = JOB_RUNNING
+        job.emit(EVENT_STATUS, status=job.status)
+        started = time.perf_counter()
+        try:
+            job.result = await job._runner(job)
+        except asyncio.CancelledError:
+            self._fail(job, "Job was cancelled")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            self._fail(job, str(e))
+            return
+        finally:
+            # Загруженные файлы задачи больше не нужны
+            job._runner = None
+
+        job.status = JOB_DONE
+        job.finished_at = time.monotonic()
+        job.emit(EVENT_DONE, result=job.result, processed=job.processed, total=job.total)
+        logger.info(f"Job {job.id} done: {job.processed} images in {time.perf_counter() - started:.2f}s")
+
+    @staticmethod
+    def _fail(job: Job, error: str):
+        job.status = JOB_FAILED
+        job.error = error
+        job.finished_at = time.monotonic()
+        job.emit(EVENT_FAILED, error=error)
+
+    def _expire(self):
+        now = time.monotonic()
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        finished.sort(key=lambda job: job.finished_at)
+        excess = len(finished) - self.max_finished
+        for index, job in enumerate(finished):
+            if index < excess or now - job.finished_at > self.ttl_seconds:
+                del self.jobs[job.id]
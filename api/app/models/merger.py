@@ -1,17 +1,44 @@
 # app/models/merger.py
 import numpy as np
 import torch
-from torchvision.ops import nms
+from torchvision.ops import batched_nms, nms
 
-def merge_results(result1, result2, model1_names=None, model2_names=None):
-    model1_list = results_to_list(result1[0], model1_names)
-    model2_list = results_to_list(result2[0], model2_names)
+from app.models.detections import Detections
 
-    return merge_detections(model1_list, model2_list)
+# Пороги IoU объединения: совпадение детекций двух моделей,
+# добавление несовпавших детекций второй модели, финальная NMS
+MATCH_IOU_THRESHOLD = 0.8
+UNMATCHED_IOU_THRESHOLD = 0.5
+NMS_IOU_THRESHOLD = 0.6
+
+def fuse_detections(detections_per_model, mode="greedy", engine="vectorized",
+                    wbf_iou_threshold=0.55, wbf_skip_box_threshold=0.0, wbf_weights=None, wbf_conf_type="avg"):
+    """
+    Объединение детекций N моделей одного изображения.
+    mode="greedy" - исходное попарное объединение (для N > 2 модели добавляются по очереди),
+    mode="wbf" - Weighted Boxes Fusion по всем моделям сразу.
+    Args:
+        detections_per_model: Detections каждой модели (с общей таблицей имен, см. build_class_table)
+    Returns:
+        Detections
+    """
+    if mode == "wbf":
+        return weighted_boxes_fusion_arrays(detections_per_model, iou_threshold=wbf_iou_threshold,
+                                            skip_box_threshold=wbf_skip_box_threshold, weights=wbf_weights,
+                                            conf_type=wbf_conf_type)
+
+    fused = detections_per_model[0]
+    for detections in detections_per_model[1:]:
+        if engine == "legacy":
+            # Исходная реализация на словарях - для сравнения с векторной
+            fused = Detections.from_dicts(merge_detections(fused.to_dicts(), detections.to_dicts()), fused.names)
+        else:
+            fused = merge_arrays(fused, detections)
+    return fused
 
 def merge_detections(model1_detections, model2_detections):
     final_detections = []
-    io_trash_hold = 0.8
+    io_trash_hold = MATCH_IOU_THRESHOLD
     for det1 in model1_detections:
         best_match = None
         best_iou = 0
@@ -33,14 +60,186 @@ def merge_detections(model1_detections, model2_detections):
 
     # добавляем объекты из model2, которые не совпали ни с одним объектом из model1
     for det2 in model2_detections:
-        if not any(compute_iou(det2['bbox'], d['bbox']) >= 0.5 for d in final_detections):
+        if not any(compute_iou(det2['bbox'], d['bbox']) >= UNMATCHED_IOU_THRESHOLD for d in final_detections):
             final_detections.append(det2)
 
     # финальная NMS
-    final_detections = non_max_suppression(final_detections, iou_threshold=0.6)
+    final_detections = non_max_suppression(final_detections, iou_threshold=NMS_IOU_THRESHOLD)
     return final_detections
 
 
+def merge_arrays(detections1, detections2):
+    """
+    Объединение детекций двух моделей на массивах:
+    матрица IoU между моделями считается за один проход, сопоставление - через argmax,
+    финальная NMS - одна батчевая class-aware NMS.
+    Обе стороны должны использовать одну таблицу имен классов.
+    """
+    boxes1, scores1, classes1 = detections1.boxes, detections1.scores, detections1.classes
+    boxes2, scores2, classes2 = detections2.boxes, detections2.scores, detections2.classes
+
+    # Сопоставление: для каждой детекции model1 - лучшая по IoU детекция model2
+    if len(boxes1) and len(boxes2):
+        ious = iou_matrix(boxes1, boxes2)
+        best = ious.argmax(axis=1)
+        best_iou = ious[np.arange(len(boxes1)), best]
+    else:
+        best = np.zeros(len(boxes1), dtype=np.int64)
+        best_iou = np.zeros(len(boxes1))
+    matched = best_iou >= MATCH_IOU_THRESHOLD
+
+    final_boxes = boxes1.copy()
+    final_scores = scores1.copy()
+    final_classes = classes1.copy()
+    if matched.any():
+        s1 = scores1[matched]
+        s2 = scores2[best[matched]]
+        c1 = classes1[matched]
+        c2 = classes2[best[matched]]
+        final_boxes[matched] = (boxes1[matched] * s1[:, None] + boxes2[best[matched]] * s2[:, None]) / (s1 + s2)[:, None]
+        final_scores[matched] = (s1 + s2) / 2
+        final_classes[matched] = np.where((c1 == c2) | (s1 >= s2), c1, c2)
+
+    # Детекции model2, не совпавшие ни с одной уже принятой детекцией
+    added = []
+    if len(boxes2):
+        blocked = np.zeros(len(boxes2), dtype=bool)
+        if len(final_boxes):
+            blocked = (iou_matrix(boxes2, final_boxes) >= UNMATCHED_IOU_THRESHOLD).any(axis=1)
+        # Добавленные детекции model2 тоже участвуют в проверке последующих
+        overlaps = iou_matrix(boxes2, boxes2) >= UNMATCHED_IOU_THRESHOLD
+        for j in range(len(boxes2)):
+            if blocked[j]:
+                continue
+            added.append(j)
+            blocked |= overlaps[j]
+
+    fused = Detections(
+        np.concatenate([final_boxes, boxes2[added]]),
+        np.concatenate([final_scores, scores2[added]]),
+        np.concatenate([final_classes, classes2[added]]),
+        detections1.names,
+    )
+
+    # финальная NMS
+    return fused.select(batched_class_nms(fused, iou_threshold=NMS_IOU_THRESHOLD))
+
+
+def iou_matrix(boxes1, boxes2):
+    """
+    Матрица IoU между массивами боксов (N, 4) и (M, 4) в формате [x1, y1, x2, y2]
+    """
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    return inter_area / (area1[:, None] + area2[None, :] - inter_area + 1e-6)
+
+
+def ios_matrix(boxes1, boxes2):
+    """
+    Матрица пересечения, деленного на площадь меньшего бокса (IoS).
+    В отличие от IoU, близка к 1, когда один бокс - обрезанная часть другого.
+    """
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    return inter_area / (np.minimum(area1[:, None], area2[None, :]) + 1e-6)
+
+
+def weighted_boxes_fusion_arrays(detections_per_model, iou_threshold=0.55, skip_box_threshold=0.0, weights=None,
+                                 conf_type="avg"):
+    """
+    Weighted Boxes Fusion для произвольного числа моделей.
+    Внутри каждого класса боксы обходятся по убыванию уверенности; бокс присоединяется
+    к кластеру с максимальным IoU (> iou_threshold) с его текущим слитым боксом, иначе
+    открывает новый кластер. Слитый бокс - среднее боксов кластера, взвешенное по уверенности,
+    уверенность - средняя по кластеру (conf_type="avg") или, при conf_type="box_and_model_avg",
+    дополнительно умноженная на долю моделей, нашедших объект: с N моделями объект,
+    найденный одной из них, получает 1/N своей уверенности.
+    Args:
+        detections_per_model: Detections каждой модели (с общей таблицей имен)
+        iou_threshold: порог IoU для присоединения к кластеру
+        skip_box_threshold: детекции с меньшей уверенностью отбрасываются
+        weights: веса моделей (по умолчанию одинаковые)
+        conf_type: "avg" - без штрафа за число моделей, "box_and_model_avg" - со штрафом
+    """
+    if conf_type not in ("avg", "box_and_model_avg"):
+        raise ValueError(f"Unknown WBF confidence type: {conf_type}")
+    n_models = len(detections_per_model)
+    names = detections_per_model[0].names if detections_per_model else []
+    weights = np.ones(n_models) if weights is None else np.asarray(weights, dtype=np.float64)
+    total_weight = weights.sum()
+
+    parts = []
+    for model_index, detections in enumerate(detections_per_model):
+        part = detections.select(detections.scores >= skip_box_threshold)
+        parts.append(Detections(part.boxes, part.scores * weights[model_index], part.classes, names))
+    pooled = Detections.concat(parts, names)
+    boxes, scores, classes = pooled.boxes, pooled.scores, pooled.classes
+    box_weights = np.repeat(weights, [len(part) for part in parts]) if parts else np.zeros(0)
+
+    fused_boxes_all, fused_scores_all, fused_classes_all = [], [], []
+    # Классы в порядке первого появления
+    _, first_index = np.unique(classes, return_index=True)
+    for class_code in classes[np.sort(first_index)]:
+        indices = np.flatnonzero(classes == class_code)
+        indices = indices[np.argsort(-scores[indices], kind="stable")]
+
+        # Накопители кластеров: сумма score*box, сумма score, сумма весов моделей, число боксов, текущий слитый бокс
+        weighted_sums = np.zeros((len(indices), 4))
+        score_sums = np.zeros(len(indices))
+        weight_sums = np.zeros(len(indices))
+        counts = np.zeros(len(indices), dtype=np.int64)
+        fused_boxes = np.zeros((len(indices), 4))
+        n_clusters = 0
+
+        for idx in indices:
+            cluster = -1
+            if n_clusters:
+                ious = iou_matrix(boxes[idx:idx + 1], fused_boxes[:n_clusters])[0]
+                best = int(ious.argmax())
+                if ious[best] > iou_threshold:
+                    cluster = best
+            if cluster < 0:
+                cluster = n_clusters
+                n_clusters += 1
+            weighted_sums[cluster] += boxes[idx] * scores[idx]
+            score_sums[cluster] += scores[idx]
+            weight_sums[cluster] += box_weights[idx]
+            counts[cluster] += 1
+            fused_boxes[cluster] = weighted_sums[cluster] / score_sums[cluster]
+
+        if conf_type == "avg":
+            # Взвешенное среднее исходных уверенностей кластера
+            confidences = score_sums[:n_clusters] / np.maximum(weight_sums[:n_clusters], 1e-12)
+        else:
+            confidences = score_sums[:n_clusters] / counts[:n_clusters]
+            confidences = confidences * np.minimum(counts[:n_clusters], total_weight) / total_weight
+        fused_boxes_all.append(fused_boxes[:n_clusters])
+        fused_scores_all.append(confidences)
+        fused_classes_all.append(np.full(n_clusters, class_code, dtype=np.int64))
+
+    if not fused_scores_all:
+        return Detections.empty(names)
+    fused = Detections(np.concatenate(fused_boxes_all), np.concatenate(fused_scores_all),
+                       np.concatenate(fused_classes_all), names)
+    return fused.select(np.argsort(-fused.scores, kind="stable"))
+
+
 def compute_iou(box1, box2):
     """
     box = [x1, y1, x2, y2]
@@ -98,17 +297,28 @@ def non_max_suppression(detections, iou_threshold=0.6):
 
     return final_dets
 
-def results_to_list(results, local_names):
-    dets = []
-    for box in results.boxes:
-        x1, y1, x2, y2 = box.xyxy[0].tolist()
-        confidence = float(box.conf[0])
-        class_id = int(box.cls[0])
-        class_name = local_names.get(class_id)
-
-        dets.append({
-            'bbox': [x1, y1, x2, y2],
-            'confidence': confidence,
-            'class': class_name,
-        })
-    return dets
+def batched_class_nms(detections, iou_threshold=0.6):
+    """
+    Class-aware NMS одним вызовом для всех классов.
+    Возвращает индексы оставленных детекций в порядке non_max_suppression:
+    классы в порядке первого появления, внутри класса - по убыванию уверенности.
+    """
+    if not len(detections):
+        return np.zeros(0, dtype=np.int64)
+
+    classes = detections.classes
+    keep = batched_nms(
+        torch.from_numpy(detections.boxes.astype(np.float32)),
+        torch.from_numpy(detections.scores.astype(np.float32)),
+        torch.from_numpy(classes),
+        iou_threshold,
+    ).numpy()
+
+    # Ранг класса - порядок его первого появления
+    unique, first_index = np.unique(classes, return_index=True)
+    rank = np.empty(unique.max() + 1, dtype=np.int64)
+    rank[unique] = np.argsort(np.argsort(first_index))
+
+    # batched_nms сортирует по уверенности; стабильная сортировка по рангу класса сохраняет её внутри класса
+    return keep[np.argsort(rank[classes[keep]], kind="stable")]
+
@@ -0,0 +1,203 @@
+# app/models/overlay_store.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from app.models.cache import LRUCache
+from app.models.renderer import Box, OverlayRenderer
+
+logger = logging.getLogger(__name__)
+
+# Идентификаторы результатов генерируются детектором: цифры, буквы, '_' и '-'
+_RESULT_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class OverlayStore:
+    def __init__(self, results_dir: Path, sources_dir: Path, renderer: OverlayRenderer, cache_bytes: int,
+                 max_source_bytes: int = 0, retention_seconds: float = 0, cleanup_interval: float = 600):
+        """
+        Ленивая отрисовка результатов.
+        При распознавании сохраняются только детекции и исходный файл,
+        изображение с рамками рисуется при первом запросе нужного размера
+        и хранится в LRU-кэше, ограниченном по объему.
+        Args:
+            results_dir: каталог для файлов с детекциями (<id>.json)
+            sources_dir: каталог для исходных изображений
+            renderer: стадия отрисовки
+            cache_bytes: максимальный объем кэша отрисованных изображений, байт
+            max_source_bytes: максимальный объем исходников на диске, байт (0 - без ограничения);
+                сверх него удаляются давно не использованные
+            retention_seconds: срок хранения результата и исходника (0 - без ограничения)
+            cleanup_interval: период фоновой очистки, с
+        Исходники именуются по хэшу содержимого: повторно загруженный файл хранится один раз.
+        """
+        self.results_dir = Path(results_dir)
+        self.sources_dir = Path(sources_dir)
+        self.renderer = renderer
+        self.cache = LRUCache(max_bytes=cache_bytes)
+        self._inflight: Dict[Tuple[str, Optional[int]], asyncio.Future] = {}
+        self.max_source_bytes = max_source_bytes
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval = cleanup_interval
+        self._cleaner: Optional[asyncio.Task] = None
+
+        self.results_dir.mkdir(parents=True, exist_ok=True)
+        self.sources_dir.mkdir(parents=True, exist_ok=True)
+
+    async def save(self, result_id: str, image: Union[bytes, Image.Image], extension: str, boxes: List[Box]):
+        """Сохранить исходное изображение и детекции для последующей отрисовки"""
+        await asyncio.to_thread(self._save, result_id, image, extension, boxes)
+
+    def _save(self, result_id: str, image: Union[bytes, Image.Image], extension: str, boxes: List[Box]):
+        if isinstance(image, (bytes, bytearray)):
+            source_path = self.sources_dir / f"{hashlib.blake2b(image, digest_size=20).hexdigest()}{extension}"
+            if not self._touch(source_path):
+                self._write_atomic(source_path, lambda path: Path(path).write_bytes(image))
+        else:
+            # Для массивов и уже декодированных изображений исходного файла нет
+            digest = hashlib.blake2b(f"{image.mode}{image.size}".encode() + image.tobytes(), digest_size=20)
+            source_path = self.sources_dir / f"{digest.hexdigest()}.png"
+            if not self._touch(source_path):
+                self._write_atomic(source_path, lambda path: image.save(path, format="PNG"))
+
+        with open(self.results_dir / f"{result_id}.json", 'w', encoding='utf-8') as file:
+            json.dump({"source": source_path.name, "boxes": boxes}, file)
+
+    async def get(self, result_id: str, size: Optional[int] = None) -> Optional[bytes]:
+        """JPEG с рамками; None - результат не найден"""
+        if not _RESULT_ID.match(result_id):
+            return None
+
+        key = (result_id, size)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        # Одновременные запросы одного и того же изображения ждут одну отрисовку
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            rendered = await self._render(result_id, size)
+            if rendered is not None:
+                self.cache.put(key, rendered)
+            future.set_result(rendered)
+            return rendered
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано вызывающему; ожидающие получат его через future
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _render(self, result_id: str, size: Optional[int]) -> Optional[bytes]:
+        loaded = await asyncio.to_thread(self._load, result_id)
+        if loaded is None:
+            return None
+        encoded, boxes = loaded
+        return await self.renderer.render_jpeg(encoded, boxes, size)
+
+    def _load(self, result_id: str) -> Optional[Tuple[bytes, List[Box]]]:
+        meta_path = self.results_dir / f"{result_id}.json"
+        if not meta_path.exists():
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as file:
+            meta = json.load(file)
+        try:
+            encoded = (self.sources_dir / meta["source"]).read_bytes()
+        except FileNotFoundError:
+            # Исходник удален очисткой
+            return None
+        return encoded, [(bbox, color) for bbox, color in meta["boxes"]]
+
+    @staticmethod
+    def _touch(path: Path) -> bool:
+        """Исходник уже сохранен: обновляем время использования для очистки; False - файла нет"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def _write_atomic(path: Path, write):
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if temp_path.exists():
+                temp_path.unlink()
+
+    def start(self):
+        """Запуск фоновой очистки (нужен работающий event loop)"""
+        if (self.max_source_bytes or self.retention_seconds) and (self._cleaner is None or self._cleaner.done()):
+            self._cleaner = asyncio.create_task(self._clean_periodically())
+
+    def stop(self):
+        if self._cleaner is not None:
+            self._cleaner.cancel()
+            self._cleaner = None
+
+    async def _clean_periodically(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.cleanup)
+            except Exception as e:
+                logger.error(f"Overlay cleanup error: {str(e)}")
+            await asyncio.sleep(self.cleanup_interval)
+
+    def cleanup(self) -> Tuple[int, int]:
+        """
+        Удаление результатов и исходников старше retention_seconds, затем - давно
+        не использованных исходников, пока их объем больше max_source_bytes.
+        Returns:
+            (удалено файлов детекций, удалено исходников)
+        """
+        now = time.time()
+        removed_meta = removed_sources = 0
+        if self.retention_seconds:
+            for meta_path in self.results_dir.glob("*.json"):
+                try:
+                    if now - meta_path.stat().st_mtime > self.retention_seconds:
+                        meta_path.unlink()
+                        removed_meta += 1
+                except FileNotFoundError:
+                    pass
+
+        sources = []
+        for path in self.sources_dir.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.is_file() and not path.name.startswith("."):
+                sources.append((stat.st_mtime, stat.st_size, path))
+        sources.sort()
+
+        total = sum(size for _, size, _ in sources)
+        for mtime, size, path in sources:
+            expired = self.retention_seconds and now - mtime > self.retention_seconds
+            if not expired and (not self.max_source_bytes or total <= self.max_source_bytes):
+                break
+            try:
+                path.unlink()
+                removed_sources += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        if removed_meta or removed_sources:
+            logger.info(f"Overlay cleanup: removed {removed_meta} results and {removed_sources} sources")
+        return removed_meta, removed_sources
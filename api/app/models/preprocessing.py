@@ -0,0 +1,62 @@
+# app/models/preprocessing.py
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+LETTERBOX_COLOR = 114
+
+
+@dataclass
+class PreparedImage:
+    """
+    Вход модели, построенный один раз и общий для всех моделей с тем же размером входа.
+    tensor - (3, size, size) float32 в [0, 1]; gain и pad - параметры letterbox
+    для перевода боксов обратно; image_size - размер изображения до letterbox.
+    """
+    tensor: np.ndarray
+    gain: float
+    pad: Tuple[int, int]
+    image_size: Tuple[int, int]
+
+
+def letterbox(image: Image.Image, size: int) -> Tuple[np.ndarray, float, Tuple[int, int]]:
+    """Масштабирование с сохранением пропорций и дополнением до квадрата size x size (как в ultralytics)"""
+    width, height = image.size
+    gain = min(size / height, size / width)
+    new_width, new_height = int(round(width * gain)), int(round(height * gain))
+    left = int(round((size - new_width) / 2 - 0.1))
+    top = int(round((size - new_height) / 2 - 0.1))
+
+    canvas = np.full((size, size, 3), LETTERBOX_COLOR, dtype=np.uint8)
+    resized = image if (new_width, new_height) == (width, height) else image.resize((new_width, new_height), Image.BILINEAR)
+    canvas[top:top + new_height, left:left + new_width] = np.asarray(resized)
+    return canvas, gain, (left, top)
+
+
+def prepare_image(image: Image.Image, size: int) -> PreparedImage:
+    """Letterbox, HWC -> CHW и нормализация в [0, 1]"""
+    canvas, gain, pad = letterbox(image, size)
+    tensor = np.ascontiguousarray(canvas.transpose(2, 0, 1), dtype=np.float32)
+    tensor /= 255
+    return PreparedImage(tensor, gain, pad, image.size)
+
+
+def prepare_images(images: List[Image.Image], size: int) -> List[PreparedImage]:
+    return [prepare_image(image, size) for image in images]
+
+
+def stack(prepared: List[PreparedImage]) -> np.ndarray:
+    """Батч (B, 3, size, size) для одного прохода модели"""
+    return np.stack([item.tensor for item in prepared])
+
+
+def to_image_coordinates(boxes: np.ndarray, prepared: PreparedImage) -> np.ndarray:
+    """Боксы из координат входа модели обратно в координаты изображения"""
+    left, top = prepared.pad
+    boxes = (boxes - np.array([left, top, left, top], dtype=boxes.dtype)) / prepared.gain
+    width, height = prepared.image_size
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+    return boxes
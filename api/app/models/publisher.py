@@ -0,0 +1,173 @@
+# app/models/publisher.py
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+import aio_pika
+
+logger = logging.getLogger(__name__)
+
+
+class ResultPublisher:
+    def __init__(self, url: str, routing_key: str = "analysis_results", channels: int = 2,
+                 batch_window_ms: float = 20.0, max_batch: int = 50, outbox_size: int = 1000,
+                 retry_delay: float = 2.0, encoder: Optional[Callable[[dict], Tuple[bytes, str]]] = None):
+        """
+        Постоянное подключение к RabbitMQ для публикации результатов распознавания.
+        publish() только кладет сообщение в локальный буфер (outbox) и не ждет брокера.
+        Обработчики (по одному на канал пула) собирают сообщения, пришедшие за batch_window_ms,
+        и публикуют их с подтверждениями брокера (publisher confirms); неподтвержденные
+        сообщения возвращаются в начало буфера и отправляются после восстановления связи.
+        Буфер ограничен: при переполнении вытесняются самые старые сообщения.
+        Args:
+            url: адрес RabbitMQ
+            routing_key: очередь результатов (durable, ее же читает app2)
+            channels: число каналов (параллельных публикаций)
+            batch_window_ms: окно накопления пачки сообщений
+            max_batch: максимальный размер пачки
+            outbox_size: максимум сообщений в буфере
+            retry_delay: пауза перед повтором после ошибки брокера, с
+            encoder: сериализация результата -> (тело, content type); по умолчанию JSON
+        """
+        self.url = url
+        self.routing_key = routing_key
+        self.channels = max(1, int(channels))
+        self.batch_window = max(0.0, batch_window_ms) / 1000
+        self.max_batch = max(1, int(max_batch))
+        self.outbox_size = max(1, int(outbox_size))
+        self.retry_delay = retry_delay
+        self.encoder = encoder or (lambda result: (json.dumps(result).encode(), "application/json"))
+
+        # Сообщения хранятся уже сериализованными: (тело, content type)
+        self._outbox: Deque[Tuple[bytes, str]] = deque()
+        self._available: Optional[asyncio.Event] = None
+        self._connection: Optional[aio_pika.abc.AbstractRobustConnection] = None
+        self._connected: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._in_flight = 0
+        self._closing = False
+        self._counters = {"published": 0, "dropped": 0, "failed_batches": 0}
+
+    def start(self):
+        """Запуск подключения и обработчиков (нужен работающий event loop)"""
+        if self._tasks:
+            return
+        self._available = asyncio.Event()
+        self._connected = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._connect())]
+        self._tasks += [asyncio.create_task(self._worker(i)) for i in range(self.channels)]
+
+    def publish(self, result: dict):
+        """Постановка результата в буфер отправки (без ожидания брокера)"""
+        if self._closing:
+            logger.error("Publisher is shutting down, result is not queued")
+            self._counters["dropped"] += 1
+            return
+        if len(self._outbox) >= self.outbox_size:
+            self._outbox.popleft()
+            self._counters["dropped"] += 1
+            logger.error(f"Publish outbox is full ({self.outbox_size}), the oldest result was dropped")
+        self._outbox.append(self.encoder(result))
+        if self._available is not None:
+            self._available.set()
+
+    async def shutdown(self, timeout: float = 10.0):
+        """Отправка оставшихся сообщений (не дольше timeout), затем закрытие подключения"""
+        self._closing = True
+        deadline = time.monotonic() + timeout
+        while (self._outbox or self._in_flight) and self._connected is not None and self._connected.is_set() \
+                and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._outbox or self._in_flight:
+            logger.error(f"Publisher stopped with {len(self._outbox) + self._in_flight} unsent results")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def stats(self) -> dict:
+        return {
+            "connected": self._connected is not None and self._connected.is_set(),
+            "outbox": len(self._outbox),
+            "in_flight": self._in_flight,
+            **self._counters,
+        }
+
+    async def _connect(self):
+        while self._connection is None:
+            try:
+                self._connection = await aio_pika.connect_robust(self.url)
+            except Exception as e:
+                logger.error(f"Publisher cannot connect to the message queue, retrying in {self.retry_delay}s: {str(e)}")
+                await asyncio.sleep(self.retry_delay)
+        self._connected.set()
+        logger.info(f"Publisher connected to the message queue, {self.channels} channels")
+
+    async def _open_channel(self):
+        channel = await self._connection.channel(publisher_confirms=True)
+        # Очередь объявляется и здесь: сообщения не теряются, если app2 еще не запущен
+        await channel.declare_queue(self.routing_key, durable=True)
+        return channel
+
+    async def _worker(self, index: int):
+        channel = None
+        while True:
+            await self._connected.wait()
+            await self._available.wait()
+            if not self._outbox:
+                self._available.clear()
+                continue
+
+            # Небольшое окно, чтобы собрать пачку из одновременно завершившихся запросов
+            if len(self._outbox) < self.max_batch and self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            batch = [self._outbox.popleft() for _ in range(min(self.max_batch, len(self._outbox)))]
+            if not batch:
+                continue
+
+            self._in_flight += len(batch)
+            failed = batch
+            try:
+                if channel is None or channel.is_closed:
+                    channel = await self._open_channel()
+                # Публикации пачки идут конвейером, ожидаются подтверждения всех сообщений
+                confirms = await asyncio.gather(*[
+                    channel.default_exchange.publish(
+                        aio_pika.Message(body=body, content_type=content_type,
+                                         delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                        routing_key=self.routing_key,
+                    )
+                    for body, content_type in batch
+                ], return_exceptions=True)
+                failed = [message for message, confirm in zip(batch, confirms) if isinstance(confirm, BaseException)]
+                self._counters["published"] += len(batch) - len(failed)
+                if failed:
+                    error = next(confirm for confirm in confirms if isinstance(confirm, BaseException))
+                    raise RuntimeError(f"{len(failed)} of {len(batch)} messages were not confirmed: {str(error)}")
+                logger.info(f"Published {len(batch)} results to the message queue")
+            except asyncio.CancelledError:
+                self._requeue(batch)
+                raise
+            except Exception as e:
+                self._counters["failed_batches"] += 1
+                logger.error(f"Error sending to queue, {len(failed)} results kept for retry: {str(e)}")
+                self._requeue(failed)
+                channel = None
+                await asyncio.sleep(self.retry_delay)
+            finally:
+                self._in_flight -= len(batch)
+
+    def _requeue(self, batch: List[Tuple[bytes, str]]):
+        """Неподтвержденные сообщения - обратно в начало буфера, в исходном порядке"""
+        self._outbox.extendleft(reversed(batch))
+        while len(self._outbox) > self.outbox_size:
+            self._outbox.popleft()
+            self._counters["dropped"] += 1
+        self._available.set()
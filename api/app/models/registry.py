@@ -0,0 +1,179 @@
+# app/models/registry.py
+import asyncio
+import datetime
+import json
+import logging
+import os
+import re
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from PIL import Image
+
+from app.models.yolo_detector import YOLODetector
+
+logger = logging.getLogger(__name__)
+
+VERSION_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+class ModelRegistry:
+    def __init__(self, factory: Callable[[List[str]], YOLODetector], registry_path: str, models_dir: str,
+                 warmup_runs: int = 2, warmup_size: int = 640):
+        """
+        Реестр версий весов с горячей заменой детектора.
+        Новая версия загружается и прогревается в фоне, затем подменяется одним
+        присваиванием; запросы, начатые на старой версии, дорабатывают на ней,
+        после чего её батчеры останавливаются.
+        Args:
+            factory: создание детектора по списку путей весов ансамбля
+            registry_path: JSON-файл реестра (версии и активная версия переживают перезапуск)
+            models_dir: каталог весов, относительно которого указываются файлы версий
+            warmup_runs: число прогревочных проходов каждой модели перед заменой
+            warmup_size: сторона прогревочного изображения
+        """
+        self._factory = factory
+        self.path = Path(registry_path)
+        self.models_dir = Path(models_dir)
+        self.warmup_runs = max(0, int(warmup_runs))
+        self.warmup_size = warmup_size
+
+        self.versions: Dict[str, dict] = {}
+        self.status: Dict[str, str] = {}
+        self.active_version: Optional[str] = None
+        self.active: Optional[YOLODetector] = None
+        # Незавершенные запросы по экземплярам детектора
+        self._in_flight: Dict[YOLODetector, int] = {}
+        self._swap_lock = asyncio.Lock()
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            self.versions = data.get("versions", {})
+            self.active_version = data.get("active")
+            self.status = {version: "registered" for version in self.versions}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.error(f"Model registry {self.path} is unreadable: {str(e)}")
+
+    def bootstrap(self, default_paths: List[str]):
+        """
+        Загрузка активной версии при старте (синхронно, до приема запросов).
+        Если в реестре нет активной версии или её веса пропали - версия "default" из настроек.
+        """
+        version = self.active_version
+        if version not in self.versions or not self._paths_exist(self.versions[version]["paths"]):
+            if version is not None:
+                logger.warning(f"Active model version {version} is unavailable, using default weights")
+            version = "default"
+            self.versions[version] = self._entry(default_paths)
+
+        self.active = self._build(self.versions[version]["paths"])
+        self.active_version = version
+        self.status[version] = "active"
+        self._save()
+        logger.info(f"Model version {version} is active")
+
+    def register(self, version: str, model_files: List[str]) -> dict:
+        """Регистрация версии: имена файлов весов в каталоге моделей (две основные + дополнительные)"""
+        if not VERSION_PATTERN.match(version):
+            raise ValueError(f"Invalid version name: {version}")
+        if version in self.versions:
+            raise ValueError(f"Version {version} already exists")
+        if len(model_files) < 2:
+            raise ValueError("At least two model files are required")
+
+        paths = [str(self.models_dir / Path(name).name) for name in model_files]
+        if not self._paths_exist(paths):
+            raise FileNotFoundError(f"Model files not found: {', '.join(p for p in paths if not Path(p).exists())}")
+
+        self.versions[version] = self._entry(paths)
+        self.status[version] = "registered"
+        self._save()
+        logger.info(f"Model version {version} registered: {paths}")
+        return self.describe(version)
+
+    async def activate(self, version: str) -> dict:
+        """
+        Фоновая загрузка и прогрев версии, затем атомарная замена активного детектора.
+        Пока версия загружается, запросы обслуживает текущая.
+        """
+        if version not in self.versions:
+            raise KeyError(version)
+
+        async with self._swap_lock:
+            if version == self.active_version:
+                return self.describe(version)
+
+            self.status[version] = "loading"
+            try:
+                detector = await asyncio.to_thread(self._build, self.versions[version]["paths"])
+            except Exception:
+                self.status[version] = "failed"
+                raise
+
+            previous, previous_version = self.active, self.active_version
+            self.active, self.active_version = detector, version
+            self.status[version] = "active"
+            if previous_version is not None:
+                self.status[previous_version] = "registered"
+            self.versions[version]["activated"] = datetime.datetime.now().isoformat()
+            self._save()
+            logger.info(f"Model version {version} is active (was {previous_version})")
+
+            if previous is not None and not self._in_flight.get(previous):
+                previous.close()
+            return self.describe(version)
+
+    @asynccontextmanager
+    async def use(self) -> AsyncIterator[YOLODetector]:
+        """Детектор для одного запроса: весь запрос выполняется на одной версии"""
+        detector = self.active
+        self._in_flight[detector] = self._in_flight.get(detector, 0) + 1
+        try:
+            yield detector
+        finally:
+            self._in_flight[detector] -= 1
+            if not self._in_flight[detector]:
+                del self._in_flight[detector]
+                # Последний запрос на замененной версии
+                if detector is not self.active:
+                    detector.close()
+
+    def describe(self, version: str) -> dict:
+        return {"version": version, "status": self.status.get(version, "registered"), **self.versions[version]}
+
+    def overview(self) -> dict:
+        return {
+            "active": self.active_version,
+            "versions": [self.describe(version) for version in self.versions],
+        }
+
+    def _build(self, paths: List[str]) -> YOLODetector:
+        detector = self._factory(paths)
+        # Прогрев: первые проходы модели (выделение памяти, компиляция графа) не попадают на запросы
+        image = Image.new('RGB', (self.warmup_size, self.warmup_size), (114, 114, 114))
+        for model in detector.models:
+            for _ in range(self.warmup_runs):
+                model.predict([image])
+        return detector
+
+    @staticmethod
+    def _entry(paths: List[str]) -> dict:
+        return {"paths": list(paths), "created": datetime.datetime.now().isoformat()}
+
+    @staticmethod
+    def _paths_exist(paths: List[str]) -> bool:
+        return all(Path(path).exists() for path in paths)
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.path.with_suffix(".tmp")
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump({"active": self.active_version, "versions": self.versions}, file, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            logger.error(f"Error writing model registry {self.path}: {str(e)}")
@@ -0,0 +1,126 @@
+# app/models/renderer.py
+import asyncio
+import base64
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional, Tuple, Union
+
+from PIL import Image, ImageDraw
+
+logger = logging.getLogger(__name__)
+
+# Рамка для отрисовки: ([x1, y1, x2, y2], цвет)
+Box = Tuple[List[float], str]
+
+
+def _draw_boxes(image: Image.Image, boxes: List[Box]) -> Image.Image:
+    img_with_boxes = image.copy()
+    draw = ImageDraw.Draw(img_with_boxes)
+
+    img_w, img_h = image.size
+    scale = max(img_w, img_h) / 2500  # коэффициент масштабирования
+    line_width = max(2, int(6 * scale))  # минимальная толщина = 2 px
+
+    for bbox, color in boxes:
+        x1, y1, x2, y2 = bbox
+        # Рисуем рамку
+        draw.rectangle([x1, y1, x2, y2], outline=color, width=line_width)
+    return img_with_boxes
+
+
+def _open(image: Union[bytes, Image.Image]) -> Image.Image:
+    if isinstance(image, (bytes, bytearray)):
+        return Image.open(BytesIO(image)).convert('RGB')
+    return image
+
+
+def render_overlay(image: Union[bytes, Image.Image], boxes: List[Box], output_path: Optional[str] = None) -> str:
+    """
+    Отрисовка рамок, сохранение результата и кодирование в JPEG/base64.
+    Функция верхнего уровня, чтобы её можно было выполнять в отдельном процессе.
+    Args:
+        image: исходное изображение или его закодированные байты
+        boxes: рамки с цветами
+        output_path: куда сохранить изображение с рамками (None - не сохранять)
+    Returns:
+        JPEG с рамками в base64
+    """
+    img_with_boxes = _draw_boxes(_open(image), boxes)
+
+    if output_path is not None:
+        img_with_boxes.save(output_path)
+
+    buffered = BytesIO()
+    img_with_boxes.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def render_overlay_jpeg(image: Union[bytes, Image.Image], boxes: List[Box], max_size: Optional[int] = None) -> bytes:
+    """
+    Отрисовка рамок для ленивого режима: JPEG с рамками, уменьшенный так,
+    чтобы большая сторона не превышала max_size (None - исходный размер).
+    """
+    image = _open(image)
+    if max_size and max(image.size) > max_size:
+        # Сначала уменьшаем изображение и рамки, чтобы не рисовать в полном разрешении
+        ratio = max_size / max(image.size)
+        image = image.resize((max(1, round(image.width * ratio)), max(1, round(image.height * ratio))),
+                             Image.BILINEAR)
+        boxes = [([coord * ratio for coord in bbox], color) for bbox, color in boxes]
+
+    buffered = BytesIO()
+    _draw_boxes(image, boxes).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def _noop():
+    return None
+
+
+class OverlayRenderer:
+    def __init__(self, workers: int = 2, queue_size: int = 32):
+        """
+        Стадия отрисовки результатов вне event loop.
+        Args:
+            workers: число процессов отрисовки; 0 - отрисовка в потоке
+                     (PIL отпускает GIL при кодировании/декодировании)
+            queue_size: сколько изображений одновременно может ждать отрисовки
+        """
+        self.workers = max(0, int(workers))
+        self.queue_size = max(1, int(queue_size))
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self):
+        """Запуск пула; вызывается при старте приложения, до начала инференса"""
+        if self.workers and self._executor is None:
+            # fork: дочерние процессы не должны заново импортировать приложение и загружать модели
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            # Процессы создаются при первой задаче, поэтому поднимаем их сразу
+            self._executor.submit(_noop).result()
+            logger.info(f"Overlay renderer started with {self.workers} worker processes")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, image: Union[bytes, Image.Image], boxes: List[Box], output_path: Optional[str] = None) -> str:
+        return await self._submit(render_overlay, image, boxes, output_path)
+
+    async def render_jpeg(self, image: Union[bytes, Image.Image], boxes: List[Box], max_size: Optional[int] = None) -> bytes:
+        return await self._submit(render_overlay_jpeg, image, boxes, max_size)
+
+    async def _submit(self, func, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.queue_size)
+
+        async with self._slots:
+            if self._executor is None:
+                return await asyncio.to_thread(func, *args)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
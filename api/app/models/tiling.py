@@ -0,0 +1,102 @@
+# app/models/tiling.py
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.models.detections import Detections
+from app.models.merger import ios_matrix
+
+# Тайл: (x1, y1, x2, y2) в координатах исходного изображения
+Tile = Tuple[int, int, int, int]
+
+
+@dataclass
+class TilingConfig:
+    """
+    Параметры нарезки больших снимков на перекрывающиеся тайлы.
+    trigger_size - минимальная длинная сторона изображения для нарезки (0 - нарезка выключена),
+    tile_size - сторона тайла, overlap - доля перекрытия соседних тайлов,
+    match_threshold - IoS, при котором детекции из разных тайлов считаются одним объектом,
+    include_full_image - прогонять и целое изображение, чтобы не терять объекты крупнее тайла.
+    """
+    trigger_size: int = 0
+    tile_size: int = 1024
+    overlap: float = 0.2
+    match_threshold: float = 0.6
+    include_full_image: bool = True
+
+    def applies(self, image: Image.Image) -> bool:
+        return self.trigger_size > 0 and max(image.size) >= self.trigger_size and max(image.size) > self.tile_size
+
+    def key(self) -> tuple:
+        """Параметры нарезки для ключа кэша детекций"""
+        return (self.trigger_size, self.tile_size, self.overlap, self.match_threshold, self.include_full_image)
+
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: float) -> List[Tile]:
+    """Сетка тайлов, покрывающая изображение; последний тайл в ряду прижат к краю"""
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in starts(height) for x in starts(width)
+    ]
+
+
+def split_image(image: Image.Image, config: TilingConfig) -> Tuple[List[Image.Image], List[Tuple[int, int]]]:
+    """Входы моделей для одного изображения и смещения их начала координат"""
+    tiles = tile_grid(image.width, image.height, config.tile_size, config.overlap)
+    crops = [image.crop(tile) for tile in tiles]
+    offsets = [(tile[0], tile[1]) for tile in tiles]
+    if config.include_full_image:
+        crops.insert(0, image)
+        offsets.insert(0, (0, 0))
+    return crops, offsets
+
+
+def merge_tiles(parts: List[Detections], offsets: List[Tuple[int, int]], match_threshold: float = 0.6) -> Detections:
+    """
+    Детекции тайлов -> детекции целого изображения.
+    Боксы переводятся в координаты изображения, затем внутри класса жадно объединяются
+    по убыванию уверенности: детекции с IoS >= match_threshold с текущей (дубликаты
+    из зоны перекрытия и части объекта, обрезанные краем тайла) сливаются в общий
+    охватывающий бокс с уверенностью лучшей из них.
+    """
+    names = parts[0].names
+    shifted = [
+        Detections(part.boxes + np.array([x, y, x, y], dtype=np.float64), part.scores, part.classes, names)
+        for part, (x, y) in zip(parts, offsets)
+    ]
+    pooled = Detections.concat(shifted, names)
+    if len(pooled) < 2:
+        return pooled
+
+    pooled = pooled.select(np.argsort(-pooled.scores, kind="stable"))
+    boxes, scores, classes = pooled.boxes, pooled.scores, pooled.classes
+    # Детекция может поглотить только менее уверенные детекции своего класса
+    matches = np.triu((ios_matrix(boxes, boxes) >= match_threshold) & (classes[:, None] == classes[None, :]), k=1)
+
+    # Жадный отбор в матричном виде (как в Cluster-NMS): детекция остается, если ее не поглощает
+    # ни одна оставшаяся; итерации сходятся к результату последовательного обхода
+    keep = np.ones(len(pooled), dtype=bool)
+    while True:
+        updated = ~(matches & keep[:, None]).any(axis=0)
+        if np.array_equal(updated, keep):
+            break
+        keep = updated
+
+    # Поглощенная детекция достается первой (самой уверенной) оставшейся, которая с ней совпала
+    owner = np.where(keep, np.arange(len(pooled)), (matches & keep[:, None]).argmax(axis=0))
+    group = (np.cumsum(keep) - 1)[owner]
+    top_left = boxes[keep, :2].copy()
+    bottom_right = boxes[keep, 2:].copy()
+    np.minimum.at(top_left, group, boxes[:, :2])
+    np.maximum.at(bottom_right, group, boxes[:, 2:])
+    return Detections(np.concatenate([top_left, bottom_right], axis=1), scores[keep], classes[keep], names)
@@ -1,30 +1,108 @@
-import base64
-from io import BytesIO
-from ultralytics import YOLO
-from PIL import Image, ImageDraw
 from pathlib import Path
-from typing import Dict, Any
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
 from datetime import datetime
 import asyncio
-from app.models.merger import merge_results
+from app.models.backends import create_backend
+from app.models.batcher import MicroBatcher
+from app.models.cascade import (PATH_CACHE, PATH_ESCALATED, PATH_PARALLEL, PATH_PRIMARY, CascadeRules,
+                                ambiguity_reasons)
+from app.models.decoding import DecodedImage, ImageSource, decode_image, source_name
+from app.models.detection_cache import DetectionCache, weights_fingerprint
+from app.models.detections import Detections, build_class_table
+from app.models.merger import MATCH_IOU_THRESHOLD, NMS_IOU_THRESHOLD, UNMATCHED_IOU_THRESHOLD, fuse_detections
+from app.models.overlay_store import OverlayStore
+from app.models.preprocessing import prepare_images
+from app.models.renderer import OverlayRenderer
+from app.models.tiling import TilingConfig, merge_tiles, split_image
+import logging
+import threading
 import time
+import uuid
+
+logger = logging.getLogger(__name__)
 
 class YOLODetector:
-    def __init__(self, model_path1: str, model_path2: str, confidence_threshold: float = 0.5):
+    def __init__(self, model_path1: str, model_path2: str, confidence_threshold: float = 0.5,
+                 max_batch_size: int = 8, batch_window_ms: float = 5.0,
+                 renderer: Optional[OverlayRenderer] = None, overlay_store: Optional[OverlayStore] = None,
+                 render_mode: str = "eager", detection_cache: Optional[DetectionCache] = None,
+                 merge_engine: str = "vectorized", extra_model_paths: Optional[List[str]] = None,
+                 fusion_mode: str = "greedy", wbf_iou_threshold: float = 0.55, wbf_skip_box_threshold: float = 0.0,
+                 wbf_conf_type: str = "avg",
+                 ensemble_mode: str = "parallel", cascade_rules: Optional[CascadeRules] = None,
+                 backend: str = "torch", backend_sessions: int = 2, backend_threads: int = 0,
+                 tiling: Optional[TilingConfig] = None, scaled_decode: bool = True):
         """
-        Детектор с двумя моделями YOLO
+        Детектор с ансамблем моделей YOLO (две основные + дополнительные)
         Args:
             model_path1: путь к первой модели
             model_path2: путь ко второй модели
             confidence_threshold: порог уверенности
+            max_batch_size: максимальный размер батча, собираемого из конкурентных запросов
+            batch_window_ms: окно ожидания изображений для батча, мс
+            renderer: стадия отрисовки результатов (по умолчанию - в потоке)
+            overlay_store: хранилище для ленивой отрисовки
+            render_mode: "eager" - рисовать рамки сразу, "lazy" - по запросу через overlay_store
+            detection_cache: кэш результатов по содержимому изображения (None - без кэша)
+            merge_engine: "vectorized" - объединение на массивах, "legacy" - исходное на словарях
+            extra_model_paths: пути к дополнительным моделям ансамбля
+            fusion_mode: "greedy" - попарное объединение по IoU, "wbf" - Weighted Boxes Fusion
+            wbf_iou_threshold: порог IoU кластеризации для WBF
+            wbf_skip_box_threshold: минимальная уверенность детекции для WBF
+            wbf_conf_type: уверенность кластера WBF: "avg" - среднее, "box_and_model_avg" - со штрафом
+                за число моделей, не нашедших объект (до фильтра уверенности 0.50)
+            ensemble_mode: "parallel" - все модели на каждом изображении,
+                "cascade" - сначала первая модель, ансамбль только для неоднозначных изображений
+            cascade_rules: правила эскалации для каскадного режима
+            backend: "torch" - ultralytics/PyTorch, "onnx" - ONNX Runtime, "openvino" - OpenVINO
+            backend_sessions: число сессий runtime на модель (для onnx/openvino)
+            backend_threads: потоков на сессию runtime (0 - по умолчанию)
+            tiling: нарезка больших изображений на тайлы (по умолчанию выключена)
+            scaled_decode: декодировать JPEG с уменьшением до размера входа моделей
         """
         self.confidence_threshold = confidence_threshold
-        # Инициализируем обе модели как YOLO
-        self.models = [YOLO(model_path1), YOLO(model_path2)]
+        self.merge_engine = merge_engine
+        self.fusion_mode = fusion_mode
+        self.wbf_iou_threshold = wbf_iou_threshold
+        self.wbf_skip_box_threshold = wbf_skip_box_threshold
+        self.wbf_conf_type = wbf_conf_type
+        self.ensemble_mode = ensemble_mode
+        self.cascade_rules = cascade_rules or CascadeRules()
+        self.tiling = tiling or TilingConfig()
+        self.model_paths = [model_path1, model_path2, *(extra_model_paths or [])]
+        # Инициализируем все модели ансамбля через выбранный бэкенд инференса
+        self.models = [
+            create_backend(model_path, backend, backend_sessions, backend_threads)
+            for model_path in self.model_paths
+        ]
         
         for model in self.models:
             model.conf = confidence_threshold
 
+        # Общая таблица классов ансамбля: детекции хранятся массивами с кодами классов
+        self.class_names, self.class_maps = build_class_table([model.names for model in self.models])
+
+        # JPEG декодируется с уменьшением до входа моделей; при нарезке на тайлы нужно полное разрешение
+        self.decode_size = (
+            max(model.imgsz for model in self.models)
+            if scaled_decode and self.tiling.trigger_size <= 0 else None
+        )
+
+        # Планировщики микробатчей: по одному на модель, проходы одной модели не пересекаются
+        self.batchers = [
+            MicroBatcher(model.predict_prepared, max_batch_size, batch_window_ms, name=f"model{i + 1}",
+                         concurrency=model.pool_size)
+            for i, model in enumerate(self.models)
+        ]
+
+        self.renderer = renderer or OverlayRenderer(workers=0)
+        self.overlay_store = overlay_store
+        self.render_mode = render_mode
+
+        self.detection_cache = detection_cache
+        # Идентичность весов входит в ключ кэша: новые веса не получат старых результатов
+        self.model_fingerprint = weights_fingerprint(self.model_paths) if detection_cache is not None else ""
+
         # Цвета для классов
         self.class_colors = {
             "screwdriver_1": "#1f77b4",        # Синий
@@ -41,82 +119,341 @@ class YOLODetector:
             "Adjustable_wrench": "#9c27b0",    # Пурпурный
         }
 
+    def close(self):
+        """Остановка планировщиков микробатчей (детектор выведен из работы)"""
+        for batcher in self.batchers:
+            batcher.close()
+
     def update_confidence_threshold(self, threshold: float):
         """Обновление порога уверенности"""
         self.confidence_threshold = threshold
         for model in self.models:
             model.conf = threshold
 
-    async def _run_model(self, model, image):
-        """Асинхронный запуск одной модели"""
-        return await asyncio.to_thread(model, image)
-
-    async def detect_image(self, image_path: str) -> Dict[str, Any]:
+    async def detect_image(self, source: ImageSource, file_name: Optional[str] = None) -> Dict[str, Any]:
         """
         Детекция изображения с двумя моделями (асинхронно).
         Для каждого класса оставляем результат с максимальной уверенностью.
+        Args:
+            source: путь к файлу, байты загруженного файла, файловый объект или массив NumPy
+            file_name: исходное имя файла (используется для расширения сохраняемого результата)
+        """
+        decoded = await asyncio.to_thread(self._decode, source)
+        results = await self._detect_decoded([decoded], [file_name or source_name(source)])
+        return results[0]
+
+    async def detect_images(self, sources: List[ImageSource], batch_size: int = 8,
+                            file_names: Optional[List[str]] = None) -> List[Optional[Dict[str, Any]]]:
+        """
+        Батчевая детекция списка изображений.
+        Каждая модель получает за один проход до batch_size изображений,
+        объединение результатов выполняется по каждому изображению отдельно.
+        Возвращает список той же длины; None - изображение не удалось прочитать.
         """
-        image = Image.open(image_path).convert('RGB')
+        batch_size = max(1, int(batch_size))
+        if file_names is None:
+            file_names = [source_name(source) for source in sources]
+        outputs: List[Optional[Dict[str, Any]]] = []
+
+        for offset in range(0, len(sources), batch_size):
+            chunk = sources[offset:offset + batch_size]
+            decoded = await asyncio.to_thread(self._load_images, chunk)
+            outputs.extend(await self._detect_decoded(decoded, file_names[offset:offset + batch_size]))
+
+        return outputs
+
+    async def detect_stream(self, sources: Iterable[Tuple[str, ImageSource]], batch_size: int = 8,
+                            max_in_flight: int = 16) -> AsyncIterator[Tuple[str, Optional[Dict[str, Any]]]]:
+        """
+        Потоковая детекция: чтение и декодирование -> инференс -> объединение.
+        sources - ленивый (в т.ч. блокирующий) итератор пар (имя, изображение),
+        например члены zip-архива. Декодирование идёт в отдельном потоке
+        параллельно с инференсом, в памяти держится не больше max_in_flight
+        декодированных изображений. Батч формируется из того, что уже готово,
+        поэтому первые результаты появляются сразу.
+        Выдает пары (имя, результат) в исходном порядке; результат None - изображение не прочитано.
+        """
+        batch_size = max(1, int(batch_size))
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, int(max_in_flight)))
+        done = object()
+        iterator = iter(sources)
+        # Остановка чтения, если потребитель прекратил обход раньше конца источника
+        stop = threading.Event()
+        # Текущее чтение в потоке: отмена задачи не останавливает поток, его дожидаемся в finally
+        pending: Optional[asyncio.Future] = None
+
+        def next_decoded():
+            if stop.is_set():
+                return done
+            item = next(iterator, done)
+            if item is done:
+                return done
+            name, source = item
+            return name, self._load_images([source])[0]
+
+        def close_sources():
+            # Генератор (например, члены zip-архива) закрывает открытый член до закрытия архива
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+        async def produce():
+            nonlocal pending
+            try:
+                while True:
+                    pending = asyncio.ensure_future(asyncio.to_thread(next_decoded))
+                    item = await asyncio.shield(pending)
+                    await queue.put(item)
+                    if item is done:
+                        break
+            except Exception as e:
+                await queue.put(e)
+
+        producer = asyncio.create_task(produce())
+        try:
+            finished = False
+            while not finished:
+                chunk = [await queue.get()]
+                while len(chunk) < batch_size and not queue.empty():
+                    chunk.append(queue.get_nowait())
+
+                for item in chunk:
+                    if isinstance(item, Exception):
+                        raise item
+                if chunk[-1] is done:
+                    chunk.pop()
+                    finished = True
+                if not chunk:
+                    continue
+
+                names = [name for name, _ in chunk]
+                results = await self._detect_decoded([image for _, image in chunk], names)
+                for name, result in zip(names, results):
+                    yield name, result
+        finally:
+            stop.set()
+            producer.cancel()
+            await asyncio.gather(producer, return_exceptions=True)
+            if pending is not None:
+                await asyncio.gather(asyncio.shield(pending), return_exceptions=True)
+            await asyncio.to_thread(close_sources)
+
+    async def _detect_decoded(self, decoded: List[Optional[DecodedImage]],
+                              file_names: List[Optional[str]]) -> List[Optional[Dict[str, Any]]]:
+        """Батчевый проход всех моделей ансамбля по уже декодированным изображениям"""
+        outputs: List[Optional[Dict[str, Any]]] = [None] * len(decoded)
+        indices = [i for i, image in enumerate(decoded) if image is not None]
+        if not indices:
+            return outputs
 
         start = time.time()
+        merged: Dict[int, Detections] = {}
+        paths: Dict[int, str] = {}
+        cache_keys: Dict[int, str] = {}
 
-        # Запускаем обе модели параллельно
-        results_list = await asyncio.gather(
-            *[self._run_model(model, image) for model in self.models]
+        # Повторно загруженные изображения берем из кэша, не запуская модели
+        if self.detection_cache is not None:
+            params = self._cache_params()
+            for i in indices:
+                cache_keys[i] = self.detection_cache.make_key(decoded[i].content_digest(), self.model_fingerprint, params)
+                cached = await self.detection_cache.get(cache_keys[i])
+                if cached is not None:
+                    merged[i] = cached
+                    paths[i] = PATH_CACHE
+        cached_indices = set(merged)
+
+        pending = [i for i in indices if i not in merged]
+        if pending:
+            if self.ensemble_mode == "cascade":
+                await self._run_cascade(decoded, pending, merged, paths)
+            else:
+                await self._run_ensemble(decoded, pending, merged, paths)
+
+            # Боксы - в координатах исходного изображения, даже если оно декодировано с уменьшением
+            for i in pending:
+                merged[i] = merged[i].rescaled(*decoded[i].scale)
+
+            if self.detection_cache is not None:
+                for i in pending:
+                    await self.detection_cache.put(cache_keys[i], merged[i])
+
+        # Время батча распределяем поровну между изображениями
+        processing_time = int((time.time() - start)*1000 / len(indices))
+
+        # Отрисовка всех изображений батча идет параллельно в пуле отрисовки
+        built = await asyncio.gather(*[
+            self._build_result(decoded[i], file_names[i], merged[i], processing_time)
+            for i in indices
+        ])
+        for i, result in zip(indices, built):
+            result["cached"] = i in cached_indices
+            result["inference_path"] = paths[i]
+            outputs[i] = result
+        return outputs
+
+    async def _run_models(self, model_indices: List[int], images: list) -> List[List[Detections]]:
+        """
+        Проход указанных моделей по батчу; для каждой модели - Detections каждого изображения.
+        Большие изображения (см. TilingConfig) идут в модели тайлами, детекции тайлов
+        сводятся обратно в координаты целого изображения.
+        """
+        crops, spans = [], []
+        for image in images:
+            if self.tiling.applies(image):
+                image_crops, offsets = split_image(image, self.tiling)
+            else:
+                image_crops, offsets = [image], [(0, 0)]
+            spans.append((len(crops), len(image_crops), offsets))
+            crops.extend(image_crops)
+
+        # Предобработка (letterbox, нормализация, тензор) - один раз на изображение
+        # для каждого различного размера входа, общая для всех моделей этого размера
+        sizes = {m: self.models[m].imgsz for m in model_indices}
+        prepared = {}
+        for size in set(sizes.values()):
+            prepared[size] = await asyncio.to_thread(prepare_images, crops, size)
+
+        # Модели получают весь батч, проходы выполняются параллельно;
+        # тайлы режутся на батчи не больше max_batch_size планировщика
+        results_list = await asyncio.gather(*[
+            self._submit_chunked(self.batchers[m], prepared[sizes[m]]) for m in model_indices
+        ])
+
+        per_model = []
+        for m, model_results in zip(model_indices, results_list):
+            detections = [Detections.from_arrays(*raw, self.class_maps[m], self.class_names) for raw in model_results]
+            per_image = []
+            for start, count, offsets in spans:
+                if count == 1:
+                    per_image.append(detections[start])
+                else:
+                    per_image.append(merge_tiles(detections[start:start + count], offsets, self.tiling.match_threshold))
+            per_model.append(per_image)
+        return per_model
+
+    @staticmethod
+    async def _submit_chunked(batcher: MicroBatcher, images: list) -> list:
+        if len(images) <= batcher.max_batch_size:
+            return await batcher.submit_many(images)
+        chunks = [images[i:i + batcher.max_batch_size] for i in range(0, len(images), batcher.max_batch_size)]
+        results = await asyncio.gather(*[batcher.submit_many(chunk) for chunk in chunks])
+        return [result for chunk_results in results for result in chunk_results]
+
+    def _fuse(self, detections_per_model: List[Detections]) -> Detections:
+        return fuse_detections(
+            detections_per_model, mode=self.fusion_mode, engine=self.merge_engine,
+            wbf_iou_threshold=self.wbf_iou_threshold, wbf_skip_box_threshold=self.wbf_skip_box_threshold,
+            wbf_conf_type=self.wbf_conf_type
         )
 
-        final_detections = merge_results(results_list[0], results_list[1], self.models[0].names, self.models[1].names)
+    async def _run_ensemble(self, decoded: List[Optional[DecodedImage]], pending: List[int],
+                            merged: Dict[int, Detections], paths: Dict[int, str]):
+        """Параллельный режим: все модели на каждом изображении"""
+        per_model = await self._run_models(list(range(len(self.models))), [decoded[i].image for i in pending])
+        for n, i in enumerate(pending):
+            merged[i] = self._fuse([detections[n] for detections in per_model])
+            paths[i] = PATH_PARALLEL
 
-        end_time = time.time()
-        
-        detections = []
-        for det in final_detections:
-            cls = det["class"]
-            color = self.class_colors.get(cls, "#000000")
-            if det['confidence'] < 0.50:
-                continue
-            detections.append({
-                "bbox": det["bbox"],
-                "confidence": det["confidence"],
-                "class": cls,
-                "color": color
-            })
-
-        # Сохраняем изображение с финальными боксами
-        output_dir = Path("static/results")
-        output_dir.mkdir(parents=True, exist_ok=True)
-
-        original_extension = Path(image_path).suffix or '.jpg'
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"detected_{timestamp}{original_extension}"
-        output_path = output_dir / output_filename
+    async def _run_cascade(self, decoded: List[Optional[DecodedImage]], pending: List[int],
+                           merged: Dict[int, Detections], paths: Dict[int, str]):
+        """
+        Каскадный режим: первая модель на всех изображениях,
+        остальные модели - только на изображениях с неоднозначным результатом.
+        """
+        primary = (await self._run_models([0], [decoded[i].image for i in pending]))[0]
+
+        escalated = []
+        for n, i in enumerate(pending):
+            reasons = ambiguity_reasons(primary[n], self.cascade_rules)
+            if reasons and len(self.models) > 1:
+                escalated.append(n)
+            else:
+                merged[i] = primary[n]
+                paths[i] = PATH_PRIMARY
+
+        if escalated:
+            others = await self._run_models(list(range(1, len(self.models))), [decoded[pending[n]].image for n in escalated])
+            for k, n in enumerate(escalated):
+                i = pending[n]
+                merged[i] = self._fuse([primary[n], *[detections[k] for detections in others]])
+                paths[i] = PATH_ESCALATED
 
-        img_with_boxes = image.copy()
-        draw = ImageDraw.Draw(img_with_boxes)
+        logger.info(f"Cascade: {len(escalated)} of {len(pending)} images escalated to the full ensemble")
 
-        for det in detections:
-            x1, y1, x2, y2 = det["bbox"]
-            cls = det["class"]
+    def _cache_params(self) -> tuple:
+        """
+        Параметры, от которых зависит результат объединения (часть ключа кэша).
+        В кэше - объединенные детекции до фильтра по уверенности (он применяется в _build_result),
+        поэтому порог уверенности в ключ не входит.
+        """
+        if self.fusion_mode == "wbf":
+            params = ("wbf", self.wbf_iou_threshold, self.wbf_skip_box_threshold, self.wbf_conf_type)
+        else:
+            params = ("greedy", MATCH_IOU_THRESHOLD, UNMATCHED_IOU_THRESHOLD, NMS_IOU_THRESHOLD)
+        if self.ensemble_mode == "cascade":
+            params += ("cascade", *self.cascade_rules.key())
+        if self.decode_size:
+            params += ("decode", self.decode_size)
+        if self.tiling.trigger_size > 0:
+            params += ("tiling", *self.tiling.key())
+        # Выходы разных runtime немного отличаются
+        params += tuple(getattr(model, "runtime", "torch") for model in self.models)
+        return params
+
+    def _decode(self, source: ImageSource) -> DecodedImage:
+        """Декодирование (вызывается в потоке, не в event loop)"""
+        decoded = decode_image(source, self.decode_size)
+        # Хэш нужен для image_hash в каждом результате (и ключа кэша) - считаем здесь,
+        # в потоке декодирования, а не в event loop
+        decoded.content_digest()
+        return decoded
 
-            color = self.class_colors.get(cls, "red")
+    def _load_images(self, sources: List[ImageSource]) -> List[Optional[DecodedImage]]:
+        images = []
+        for source in sources:
+            try:
+                images.append(self._decode(source))
+            except Exception as e:
+                logger.error(f"Failed to read image {source_name(source) or type(source).__name__}: {str(e)}")
+                images.append(None)
+        return images
 
-            img_w, img_h = image.size
-            scale = max(img_w, img_h) / 2500  # коэффициент масштабирования
-            line_width = max(2, int(6 * scale))  # минимальная толщина = 2 px
+    async def _build_result(self, decoded: DecodedImage, file_name: Optional[str], final_detections: Detections,
+                            processing_time: int) -> Dict[str, Any]:
+        """Фильтрация детекций, отрисовка рамок и формирование ответа"""
+        # Фильтр по маске; словари создаются один раз - для JSON-ответа
+        kept = final_detections.select(final_detections.scores >= 0.50)
+        detections = kept.to_dicts(self.class_colors)
 
-            # Рисуем рамку
-            draw.rectangle([x1, y1, x2, y2], outline=color, width=line_width)
+        original_extension = (Path(file_name).suffix if file_name else '') or '.jpg'
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Суффикс нужен, чтобы изображения одного батча не перезаписывали друг друга
+        result_id = f"{timestamp}_{uuid.uuid4().hex[:8]}"
+
+        boxes = [(det["bbox"], self.class_colors.get(det["class"], "red")) for det in detections]
+        # В процесс отрисовки передаем исходные байты файла, если они есть, а не декодированные пиксели
+        source = decoded.encoded if decoded.encoded is not None else decoded.image
 
-        img_with_boxes.save(output_path)
+        if self.render_mode == "lazy" and self.overlay_store is not None:
+            # Ленивый режим: сохраняем только детекции и исходник, рисуем по запросу
+            await self.overlay_store.save(result_id, source, original_extension, boxes)
+            image_path = f"/api/render/{result_id}"
+            img_base64 = ""
+        else:
+            # Сохраняем изображение с финальными боксами
+            output_dir = Path("static/results")
+            output_dir.mkdir(parents=True, exist_ok=True)
+            output_path = output_dir / f"detected_{result_id}{original_extension}"
 
-        buffered = BytesIO()
-        img_with_boxes.save(buffered, format="JPEG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+            # Отрисовка и кодирование выполняются вне event loop
+            img_base64 = await self.renderer.render(source, boxes, str(output_path))
+            image_path = f"/static/results/{output_path.name}"
 
         return {
             "detections": detections,
-            "image_path": f"/static/results/{output_path.name}",
-            "image_size": image.size,
-            "processing_time": int((end_time - start)*1000),
+            "image_path": image_path,
+            "image_size": decoded.size,
+            "processing_time": processing_time,
             "image_base64": img_base64,
-        }
\ No newline at end of file
+            "image_hash": decoded.content_digest(),
+        }
@@ -26,6 +26,8 @@ class ImageRecognitionDataModel(BaseModel):
     detectionTime: int
     imageConfidence: float
     imageBase64: str = ""
+    inferencePath: str = ""  # "ensemble" | "model1" | "model1+ensemble" | "cache"
+    imageHash: str = ""  # хэш содержимого исходного изображения
     results: List[RecognitionResult]
 
 class SummaryModel(BaseModel):
@@ -0,0 +1,111 @@
+import logging
+import sqlite3
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Версионированные миграции ToolsAI.db: (версия, описание, SQL).
+# Примененная версия хранится в PRAGMA user_version; новые миграции добавляются только в конец.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "baseline schema", [
+        """
+        CREATE TABLE IF NOT EXISTS RecognitionOperation
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            images_count INTEGER DEFAULT 0,
+            overall_match REAL DEFAULT 0,
+            kit_name TEXT NOT NULL,
+            recognition REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ImageRecognitionData
+        (
+            image_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_url TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            detection_time INTEGER NOT NULL,
+            image_confidence REAL NOT NULL,
+            row_results TEXT NOT NULL,
+            op_id INTEGER NOT NULL,
+
+            FOREIGN KEY (op_id) REFERENCES RecognitionOperation(id) ON DELETE CASCADE ON UPDATE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS RecognitionResult
+        (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            confidence REAL NOT NULL,
+            color TEXT,
+            image_id INTEGER NOT NULL,
+
+            FOREIGN KEY (image_id) REFERENCES ImageRecognitionData(image_id) ON DELETE CASCADE ON UPDATE CASCADE
+        )
+        """,
+    ]),
+    (2, "history indexes", [
+        # Страница истории: ORDER BY timestamp DESC LIMIT/OFFSET
+        "CREATE INDEX IF NOT EXISTS idx_operation_timestamp ON RecognitionOperation (timestamp)",
+        # Изображения операции и агрегаты по ним (SUM(detection_time), AVG(image_confidence)) - только из индекса
+        "CREATE INDEX IF NOT EXISTS idx_image_op ON ImageRecognitionData (op_id, detection_time, image_confidence)",
+        # Результаты изображения
+        "CREATE INDEX IF NOT EXISTS idx_result_image ON RecognitionResult (image_id)",
+        # Статистика по инструментам
+        "CREATE INDEX IF NOT EXISTS idx_result_name ON RecognitionResult (name, confidence)",
+        "ANALYZE",
+    ]),
+]
+
+
+def configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """
+    Настройки, действующие в пределах подключения: ожидание блокировки вместо
+    немедленной ошибки "database is locked", fsync только на checkpoint (безопасно в WAL),
+    кэш страниц и временные таблицы в памяти.
+    """
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA cache_size = -16000")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+
+def apply_migrations(db_path: str, journal_mode: str = "wal") -> int:
+    """
+    Приведение базы к последней версии схемы при старте сервиса.
+    Каждая миграция выполняется в своей транзакции вместе с обновлением user_version,
+    поэтому прерванный запуск повторяет только недовыполненную миграцию.
+    Режим журнала (WAL: читатели истории не блокируются записью консьюмера) сохраняется в файле базы.
+    Returns:
+        версия схемы после миграции
+    """
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        mode = conn.execute(f"PRAGMA journal_mode = {journal_mode}").fetchone()[0]
+        if mode.lower() != journal_mode.lower():
+            logger.warning(f"SQLite journal mode {journal_mode} is not available, using {mode}")
+        configure_connection(conn)
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, description, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Applying database migration {target}: {description}")
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            version = target
+
+        logger.info(f"Database schema version {version}, journal mode {mode}")
+        return version
+    finally:
+        conn.close()
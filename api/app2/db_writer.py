@@ -0,0 +1,223 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from app2.DTO.DataBaseClasses import RecognitionOperationModel
+from app2.database import configure_connection
+from app2.wire_format import decode_operation
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class WriterStopped(RuntimeError):
+    """Поток записи остановлен: операция не записана, сообщение нужно вернуть в очередь"""
+
+
+class OperationWriter:
+    def __init__(self, db_path: str, max_batch: int = 64, batch_window_ms: float = 50.0):
+        """
+        Запись операций распознавания в SQLite в отдельном потоке.
+        Сообщения, пришедшие за batch_window_ms (не больше max_batch), разбираются
+        и записываются одной транзакцией через executemany; submit() завершается
+        только после commit, поэтому подтверждать сообщение брокеру можно сразу после него.
+        Если транзакция пачки не прошла, операции записываются по одной,
+        чтобы ошибка в одном сообщении не задерживала остальные.
+        Args:
+            db_path: путь к базе ToolsAI.db
+            max_batch: максимум операций в одной транзакции
+            batch_window_ms: окно накопления пачки
+        """
+        self.db_path = db_path
+        self.max_batch = max(1, int(max_batch))
+        self.batch_window = max(0.0, batch_window_ms) / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped = False
+
+    def start(self):
+        """Запуск потока записи (нужен работающий event loop)"""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    async def submit(self, body: bytes, content_type: Optional[str] = None) -> int:
+        """Запись операции из тела сообщения; результат - id операции в базе после commit"""
+        if self._stopped or self._thread is None:
+            raise WriterStopped("Operation writer is not running")
+        future = self._loop.create_future()
+        self._queue.put((body, content_type, future))
+        return await future
+
+    def stop(self, timeout: float = 10.0):
+        """
+        Остановка после записи уже поставленных операций.
+        Операции, которые поток не успел взять за timeout (или поставленные после _STOP),
+        завершаются WriterStopped - их сообщения возвращаются в очередь брокера.
+        """
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        alive = self._thread.is_alive()
+        if alive:
+            logger.error(f"Operation writer did not finish in {timeout}s")
+
+        pending = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                pending.append(item)
+        if alive:
+            # Поток еще пишет текущую пачку - после нее он должен завершиться
+            self._queue.put(_STOP)
+        for _, _, future in pending:
+            self._resolve(future, error=WriterStopped("Operation writer is stopped"))
+        if pending:
+            logger.error(f"Operation writer stopped with {len(pending)} unwritten operations")
+        self._thread = None
+
+    def _run(self):
+        conn = configure_connection(sqlite3.connect(self.db_path, timeout=30, isolation_level=None))
+        try:
+            while True:
+                batch = self._collect()
+                stopping = batch and batch[-1] is _STOP
+                if stopping:
+                    batch.pop()
+                if batch:
+                    self._process(conn, batch)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while batch[-1] is not _STOP and len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _process(self, conn: sqlite3.Connection, batch: list):
+        # Разбор сообщений тоже вне event loop
+        parsed: List[Tuple[RecognitionOperationModel, asyncio.Future]] = []
+        for body, content_type, future in batch:
+            try:
+                parsed.append((RecognitionOperationModel(**decode_operation(body, content_type)), future))
+            except Exception as e:
+                self._resolve(future, error=ValueError(f"Invalid message: {str(e)}"))
+        if not parsed:
+            return
+
+        started = time.perf_counter()
+        try:
+            ids = self._write(conn, [operation for operation, _ in parsed])
+        except Exception as e:
+            if len(parsed) == 1:
+                self._resolve(parsed[0][1], error=e)
+                return
+            logger.error(f"Batch of {len(parsed)} operations failed, writing one by one: {str(e)}")
+            for operation, future in parsed:
+                try:
+                    self._resolve(future, self._write(conn, [operation])[0])
+                except Exception as single_error:
+                    self._resolve(future, error=single_error)
+            return
+
+        for (_, future), op_id in zip(parsed, ids):
+            self._resolve(future, op_id)
+        images = sum(len(operation.images) for operation, _ in parsed)
+        logger.info(f"Saved {len(parsed)} operations ({images} images) in {time.perf_counter() - started:.3f}s")
+
+    @staticmethod
+    def _next_id(conn: sqlite3.Connection, table: str, column: str) -> int:
+        """Следующий id AUTOINCREMENT-таблицы (внутри транзакции записи)"""
+        row = conn.execute(
+            f"SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0),"
+            f" COALESCE((SELECT MAX({column}) FROM {table}), 0))",
+            (table,)
+        ).fetchone()
+        return row[0] + 1
+
+    def _write(self, conn: sqlite3.Connection, operations: List[RecognitionOperationModel]) -> List[int]:
+        """
+        Одна транзакция на пачку. Идентификаторы выделяются заранее под блокировкой записи
+        (BEGIN IMMEDIATE), поэтому строки изображений и результатов вставляются executemany
+        без обращения к lastrowid.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            op_id = self._next_id(conn, "RecognitionOperation", "id")
+            image_id = self._next_id(conn, "ImageRecognitionData", "image_id")
+            operation_rows, image_rows, result_rows, op_ids = [], [], [], []
+
+            for operation in operations:
+                operation_rows.append((
+                    op_id,
+                    operation.timestamp,
+                    operation.summary.totalImages,
+                    operation.summary.averageMatch,
+                    operation.toolset,
+                    operation.recognition
+                ))
+                for img in operation.images:
+                    image_rows.append((
+                        image_id,
+                        img.imageUrl,
+                        img.fileName,
+                        img.detectionTime,
+                        img.imageConfidence,
+                        json.dumps([r.model_dump() for r in img.results]),  # сохраняем исходные результаты в JSON
+                        op_id
+                    ))
+                    result_rows.extend((res.name, res.confidence, res.color, image_id) for res in img.results)
+                    image_id += 1
+                op_ids.append(op_id)
+                op_id += 1
+
+            conn.executemany("""
+                INSERT INTO RecognitionOperation (id, timestamp, images_count, overall_match, kit_name, recognition)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, operation_rows)
+            conn.executemany("""
+                INSERT INTO ImageRecognitionData (image_id, image_url, file_name, detection_time, image_confidence, row_results, op_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, image_rows)
+            conn.executemany("""
+                INSERT INTO RecognitionResult (name, confidence, color, image_id)
+                VALUES (?, ?, ?, ?)
+            """, result_rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return op_ids
+
+    def _resolve(self, future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+        def apply():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        self._loop.call_soon_threadsafe(apply)
@@ -0,0 +1,147 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import aio_pika
+
+logger = logging.getLogger(__name__)
+
+# Fanout-обменник: каждый экземпляр сервиса распознавания получает уведомление
+SETTINGS_EXCHANGE = "settings"
+SETTINGS_CHANGED = "settings_changed"
+
+
+class UserConfigStore:
+    def __init__(self, path: str, poll_interval: float = 0.5):
+        """
+        Общий для сервисов снимок UserConfig.json в памяти.
+        Чтение настроек не обращается к диску: снимок обновляется фоновой проверкой
+        mtime файла (не реже poll_interval) и по сообщению settings_changed из RabbitMQ.
+        Запись атомарная: временный файл в том же каталоге + os.replace.
+        Args:
+            path: путь к UserConfig.json
+            poll_interval: период проверки изменения файла, с
+        """
+        self.path = Path(path)
+        self.poll_interval = poll_interval
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._signature: Optional[Tuple[int, int]] = None
+        self._watcher: Optional[asyncio.Task] = None
+        # write() и refresh() выполняются в потоках: файл и снимок с его подписью меняются согласованно
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[Dict[str, Any]]:
+        """Текущий снимок (только для чтения); None - файла нет или он не читается"""
+        return self._snapshot
+
+    def refresh(self, force: bool = False) -> bool:
+        """Перечитать файл, если он изменился; True - снимок обновлен"""
+        with self._lock:
+            return self._refresh(force)
+
+    def _refresh(self, force: bool) -> bool:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            if self._snapshot is not None:
+                logger.warning(f"Config file {self.path} disappeared, keeping the last snapshot")
+            return False
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if not force and signature == self._signature:
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            # Например, файл правят вручную: оставляем последний корректный снимок
+            logger.error(f"Config file {self.path} is unreadable: {str(e)}")
+            return False
+
+        self._snapshot, self._signature = snapshot, signature
+        logger.info(f"Config snapshot reloaded from {self.path}")
+        return True
+
+    def write(self, config: Dict[str, Any]):
+        """Атомарная запись: читатели видят либо старый, либо новый файл целиком"""
+        with self._lock:
+            self._write(config)
+
+    def _write(self, config: Dict[str, Any]):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(config, file, indent=4, ensure_ascii=False)
+                file.flush()
+                os.fsync(file.fileno())
+            # mkstemp создает файл 0600, а конфиг читают другие сервисы
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        stat = self.path.stat()
+        self._snapshot, self._signature = copy.deepcopy(config), (stat.st_mtime_ns, stat.st_size)
+
+    def start(self):
+        """Запуск фоновой проверки файла (нужен работающий event loop)"""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logger.error(f"Config watcher error: {str(e)}")
+
+
+async def publish_settings_changed(url: str):
+    """Уведомление сервисов о новых настройках (best effort: изменение файла подхватит и проверка mtime)"""
+    try:
+        connection = await aio_pika.connect_robust(url)
+        async with connection:
+            channel = await connection.channel()
+            exchange = await channel.declare_exchange(SETTINGS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+            await exchange.publish(aio_pika.Message(body=json.dumps({"event": SETTINGS_CHANGED}).encode()),
+                                   routing_key="")
+    except Exception as e:
+        logger.error(f"Error publishing settings change: {str(e)}")
+
+
+async def consume_settings_changed(url: str, store: UserConfigStore, retry_delay: float = 5.0):
+    """Подписка на settings_changed: по сообщению снимок перечитывается сразу, не дожидаясь проверки mtime"""
+    async def on_message(message: aio_pika.IncomingMessage):
+        async with message.process():
+            await asyncio.to_thread(store.refresh, True)
+
+    while True:
+        try:
+            connection = await aio_pika.connect_robust(url)
+            channel = await connection.channel()
+            exchange = await channel.declare_exchange(SETTINGS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(exchange)
+            await queue.consume(on_message)
+            logger.info("Listening for settings changes...")
+            await asyncio.Future()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Settings subscription error, retrying in {retry_delay}s: {str(e)}")
+            await asyncio.sleep(retry_delay)
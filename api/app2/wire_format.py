@@ -0,0 +1,90 @@
+import json
+from typing import Any, Dict, Optional, Tuple
+
+import msgpack
+
+# Формат сообщений analysis_results между app и app2.
+# "json" - исходный формат: RecognitionOperationModel целиком, включая imageBase64.
+# "msgpack" - компактный версионированный формат: без пикселей (изображение - по imageUrl и imageHash),
+# имена и цвета классов вынесены в таблицу, изображения и результаты - позиционные массивы.
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/x-msgpack"
+WIRE_VERSION = 1
+
+
+def encode_operation(operation: Dict[str, Any], message_format: str = "msgpack") -> Tuple[bytes, str]:
+    """RecognitionOperationModel (model_dump) -> тело сообщения и его content type"""
+    if message_format == "json":
+        return json.dumps(operation).encode(), CONTENT_TYPE_JSON
+    if message_format != "msgpack":
+        raise ValueError(f"Unknown message format: {message_format}")
+
+    classes: Dict[Tuple[str, str], int] = {}
+    images = []
+    for image in operation["images"]:
+        results = [
+            [classes.setdefault((result["name"], result["color"]), len(classes)), result["confidence"]]
+            for result in image["results"]
+        ]
+        images.append([
+            image["imageUrl"],
+            image["fileName"],
+            image["detectionTime"],
+            image["imageConfidence"],
+            image.get("inferencePath", ""),
+            image.get("imageHash", ""),
+            results,
+        ])
+
+    summary = operation["summary"]
+    payload = {
+        "v": WIRE_VERSION,
+        "id": operation["id"],
+        "ts": operation["timestamp"],
+        "kit": operation["toolset"],
+        "rec": operation["recognition"],
+        "sum": [summary["totalImages"], summary["totalDetectionTime"], summary["averageMatch"]],
+        "cls": [list(key) for key in classes],
+        "img": images,
+    }
+    return msgpack.packb(payload, use_bin_type=True), CONTENT_TYPE_MSGPACK
+
+
+def decode_operation(body: bytes, content_type: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Тело сообщения -> словарь для RecognitionOperationModel.
+    Принимаются оба формата: сообщения без content type - старый JSON.
+    """
+    if content_type != CONTENT_TYPE_MSGPACK:
+        return json.loads(body.decode())
+
+    payload = msgpack.unpackb(body, raw=False)
+    version = payload.get("v")
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported message version: {version}")
+
+    classes = payload["cls"]
+    total_images, total_time, average_match = payload["sum"]
+    return {
+        "id": payload["id"],
+        "timestamp": payload["ts"],
+        "toolset": payload["kit"],
+        "recognition": payload["rec"],
+        "summary": {"totalImages": total_images, "totalDetectionTime": total_time, "averageMatch": average_match},
+        "images": [
+            {
+                "imageId": -1,
+                "imageUrl": url,
+                "fileName": file_name,
+                "detectionTime": detection_time,
+                "imageConfidence": confidence,
+                "inferencePath": inference_path,
+                "imageHash": image_hash,
+                "results": [
+                    {"id": -1, "name": classes[index][0], "color": classes[index][1], "confidence": score}
+                    for index, score in results
+                ],
+            }
+            for url, file_name, detection_time, confidence, inference_path, image_hash, results in payload["img"]
+        ],
+    }
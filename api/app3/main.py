@@ -1,4 +1,5 @@
 
+import asyncio
 import os
 import shutil
 import tarfile
@@ -12,6 +13,7 @@ import logging
 
 from app3.dataset import create_yolo_dataset_with_yaml
 from app3.train import train_yolo_with_tuning
+from app3.quantize import quantize_model
 
 # Определяем базовую директорию проекта. Если docker-compose монтирует общий
 # том в /app, то можно настроить DATA_DIR=/app в compose. Иначе используем проектную структуру.
@@ -207,3 +209,34 @@ async def extract_two_archives(
             if file_path and file_path.exists():
                 file_path.unlink()
         return { "status": "success" }
+
+
+@app.post("/api/quantize")
+async def quantize_weights(
+    model_name: str = Form("model1.pt"),
+    runtime: str = Form("onnx"),
+    calibration_images: int = Form(200),
+    max_map_drop: float = Form(0.01)):
+    """
+    INT8-квантизация модели из DATA_DIR/models с калибровкой на images/val
+    последнего собранного датасета; возвращает отчет о точности и задержке
+    """
+    weights = BASE_DIR / "models" / Path(model_name).name
+    dataset_yaml = YMLS_DIR / "dataset.yaml"
+    if not weights.exists():
+        raise HTTPException(status_code=404, detail=f"Модель не найдена: {weights.name}")
+    if not dataset_yaml.exists():
+        raise HTTPException(status_code=400, detail="Датасет не найден, сначала загрузите архивы")
+    if runtime not in ("onnx", "openvino"):
+        raise HTTPException(status_code=400, detail="Поддерживаются только runtime onnx и openvino")
+
+    try:
+        logger.info(f"POST /api/quantize - Quantizing {weights.name} ({runtime})")
+        report = await asyncio.to_thread(
+            quantize_model, str(weights), str(dataset_yaml), runtime, calibration_images, max_map_drop=max_map_drop
+        )
+        logger.info(f"POST /api/quantize - Done, mAP50-95 drop {report['map50_95_drop']}, speedup {report['speedup']}")
+        return JSONResponse(content=report)
+    except Exception as e:
+        logger.error(f"Ошибка при квантизации: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка сервера: {str(e)}")
@@ -0,0 +1,229 @@
+import json
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+from PIL import Image
+from ultralytics import YOLO
+
+from app.models.backends import RuntimeBackend, UltralyticsBackend, artifact_path, export_artifact
+from app.models.preprocessing import prepare_image
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def val_images(dataset_yaml: str) -> list:
+    """
+    Изображения валидационной выборки датасета в формате app3 (images/val).
+
+    :param dataset_yaml: Путь к YAML файлу датасета
+    """
+    with open(dataset_yaml, "r", encoding="utf-8") as f:
+        data = yaml.safe_load(f)
+    root = Path(data.get("path") or Path(dataset_yaml).parent)
+    val_dir = root / data.get("val", "images/val")
+    if not val_dir.exists():
+        raise ValueError(f"Папка валидационных изображений не найдена: {val_dir}")
+    return sorted(p for p in val_dir.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def _detect_head_nodes(model) -> list:
+    """Узлы головы Detect (последний модуль /model.N/) - остаются в FP32, иначе сильно падает точность боксов"""
+    indices = [int(m.group(1)) for node in model.graph.node for m in [re.match(r"/model\.(\d+)/", node.name)] if m]
+    if not indices:
+        return []
+    prefix = f"/model.{max(indices)}/"
+    return [node.name for node in model.graph.node if node.name.startswith(prefix)]
+
+
+def quantize_onnx(weights: str, dataset_yaml: str, calibration_images: int = 200, seed: int = 42) -> Path:
+    """
+    Статическая INT8-квантизация ONNX Runtime (QDQ, веса по каналам)
+    с калибровкой на выборке изображений images/val.
+
+    :param weights: Путь к весам FP32 (.pt)
+    :param dataset_yaml: Путь к YAML файлу датасета
+    :param calibration_images: Количество изображений для калибровки
+    :param seed: Random seed для воспроизводимости выборки
+    :return: Путь к INT8 модели (рядом с весами, загружается бэкендом "onnx-int8")
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+
+    fp32_path = export_artifact(weights, "onnx")
+    target = artifact_path(weights, "onnx-int8")
+    fp32_model = onnx.load(str(fp32_path))
+    metadata = {prop.key: prop.value for prop in fp32_model.metadata_props}
+    imgsz = int(json.loads(metadata.get("imgsz", "[640, 640]"))[0])
+    input_name = fp32_model.graph.input[0].name
+
+    images = val_images(dataset_yaml)
+    random.seed(seed)
+    sample = random.sample(images, min(calibration_images, len(images)))
+    print(f"Калибровка на {len(sample)} изображениях из {len(images)}")
+
+    class ValReader(CalibrationDataReader):
+        def __init__(self):
+            self.paths = iter(sample)
+
+        def get_next(self):
+            path = next(self.paths, None)
+            if path is None:
+                return None
+            prepared = prepare_image(Image.open(path).convert('RGB'), imgsz)
+            return {input_name: prepared.tensor[None]}
+
+    quantize_static(
+        str(fp32_path),
+        str(target),
+        ValReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+        nodes_to_exclude=_detect_head_nodes(fp32_model),
+    )
+
+    # Метаданные ultralytics (names, imgsz) нужны бэкенду для загрузки модели
+    int8_model = onnx.load(str(target))
+    del int8_model.metadata_props[:]
+    for key, value in metadata.items():
+        int8_model.metadata_props.add(key=key, value=value)
+    onnx.save(int8_model, str(target))
+
+    print(f"INT8 модель сохранена: {target}")
+    return target
+
+
+def quantize_openvino(weights: str, dataset_yaml: str, calibration_images: int = 200) -> Path:
+    """
+    INT8-квантизация OpenVINO (NNCF) через экспорт ultralytics с калибровкой на images/val.
+
+    :param weights: Путь к весам FP32 (.pt)
+    :param dataset_yaml: Путь к YAML файлу датасета
+    :param calibration_images: Количество изображений для калибровки
+    :return: Путь к INT8 модели (рядом с весами, загружается бэкендом "openvino-int8")
+    """
+    images = val_images(dataset_yaml)
+    fraction = min(1.0, calibration_images / max(1, len(images)))
+    print(f"Калибровка на {min(calibration_images, len(images))} изображениях из {len(images)}")
+    YOLO(weights).export(format="openvino", int8=True, dynamic=True, data=dataset_yaml, fraction=fraction)
+
+    target = artifact_path(weights, "openvino-int8")
+    print(f"INT8 модель сохранена: {target}")
+    return target
+
+
+def _latency(backend, paths: list, warmup: int = 3) -> dict:
+    """Задержка инференса одного изображения (предобработка + модель + постобработка), мс"""
+    images = [Image.open(p).convert('RGB') for p in paths]
+    for image in images[:warmup]:
+        backend.predict([image])
+
+    timings = []
+    for image in images:
+        start = time.perf_counter()
+        backend.predict([image])
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean_ms": round(float(np.mean(timings)), 2),
+        "p50_ms": round(float(np.percentile(timings, 50)), 2),
+        "p95_ms": round(float(np.percentile(timings, 95)), 2),
+    }
+
+
+def _accuracy(model_path: str, dataset_yaml: str) -> dict:
+    """mAP на валидационной выборке средствами ultralytics"""
+    metrics = YOLO(model_path, task="detect").val(data=dataset_yaml, split="val", batch=1, plots=False, verbose=False)
+    return {"map50": round(float(metrics.box.map50), 4), "map50_95": round(float(metrics.box.map), 4)}
+
+
+def _size_mb(path: Path) -> float:
+    files = path.parent.rglob("*") if path.suffix == ".xml" else [path]
+    return round(sum(f.stat().st_size for f in files if f.is_file()) / 1024 / 1024, 2)
+
+
+def regression_report(weights: str, dataset_yaml: str, runtime: str = "onnx", latency_images: int = 50,
+                      max_map_drop: float = 0.01, seed: int = 42) -> dict:
+    """
+    Сравнение INT8 модели с исходной FP32 (PyTorch, как в YOLODetector): mAP, задержка, размер.
+
+    :param weights: Путь к весам FP32 (.pt)
+    :param dataset_yaml: Путь к YAML файлу датасета
+    :param runtime: "onnx" или "openvino"
+    :param latency_images: Количество изображений для замера задержки
+    :param max_map_drop: Допустимое падение mAP50-95 (абсолютное)
+    :param seed: Random seed для воспроизводимости выборки
+    """
+    int8_runtime = f"{runtime}-int8"
+    int8_path = artifact_path(weights, int8_runtime)
+    images = val_images(dataset_yaml)
+    random.seed(seed)
+    sample = random.sample(images, min(latency_images, len(images)))
+
+    print("=== Точность FP32 / INT8 ===")
+    fp32 = _accuracy(weights, dataset_yaml)
+    int8 = _accuracy(str(int8_path if runtime == "onnx" else int8_path.parent), dataset_yaml)
+
+    print("=== Задержка FP32 / INT8 ===")
+    fp32.update(_latency(UltralyticsBackend(weights), sample))
+    int8.update(_latency(RuntimeBackend(weights, int8_runtime, pool_size=1), sample))
+    fp32["size_mb"] = _size_mb(Path(weights))
+    int8["size_mb"] = _size_mb(int8_path)
+
+    map_drop = round(fp32["map50_95"] - int8["map50_95"], 4)
+    report = {
+        "weights": str(weights),
+        "int8_model": str(int8_path),
+        "runtime": int8_runtime,
+        "dataset": str(dataset_yaml),
+        "val_images": len(images),
+        "latency_images": len(sample),
+        "fp32": fp32,
+        "int8": int8,
+        "map50_95_drop": map_drop,
+        "speedup": round(fp32["mean_ms"] / int8["mean_ms"], 2) if int8["mean_ms"] else None,
+        "max_map_drop": max_map_drop,
+        "passed": map_drop <= max_map_drop,
+    }
+
+    report_path = Path(weights).with_name(f"{Path(weights).stem}_int8_report.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Отчет сохранен: {report_path}")
+    return report
+
+
+def quantize_model(weights: str, dataset_yaml: str, runtime: str = "onnx", calibration_images: int = 200,
+                   latency_images: int = 50, max_map_drop: float = 0.01) -> dict:
+    """
+    Полный конвейер: INT8-квантизация весов и отчет о регрессии точности/задержки.
+    Полученную модель YOLODetector загружает при INFERENCE_BACKEND=onnx-int8 (или openvino-int8).
+
+    :param weights: Путь к весам FP32 (.pt)
+    :param dataset_yaml: Путь к YAML файлу датасета (формат app3.dataset)
+    :param runtime: "onnx" или "openvino"
+    :param calibration_images: Количество изображений для калибровки
+    :param latency_images: Количество изображений для замера задержки
+    :param max_map_drop: Допустимое падение mAP50-95 (абсолютное)
+    """
+    if not os.path.exists(weights):
+        raise ValueError(f"Файл весов не найден: {weights}")
+    if not os.path.exists(dataset_yaml):
+        raise ValueError(f"YAML файл не найден: {dataset_yaml}")
+
+    print(f"=== Квантизация {weights} ({runtime}) ===")
+    if runtime == "onnx":
+        quantize_onnx(weights, dataset_yaml, calibration_images)
+    elif runtime == "openvino":
+        quantize_openvino(weights, dataset_yaml, calibration_images)
+    else:
+        raise ValueError(f"Неизвестный runtime: {runtime}")
+
+    return regression_report(weights, dataset_yaml, runtime, latency_images, max_map_drop)